@@ -0,0 +1,128 @@
+import collections
+import threading
+import time
+
+# One immutable snapshot per poll tick. Positions are in native counts, with the same
+# positions in mm alongside when the poller has a unit calibration (None otherwise); the
+# I/O fields are tuples of bools indexed from 0, the same way get_all_digital_inputs/outputs
+# return them.
+PollSnapshot = collections.namedtuple('PollSnapshot',
+                                      ['timestamp', 'x', 'y', 'z',
+                                       'xy_inputs', 'xy_outputs', 'z_inputs', 'z_outputs',
+                                       'device_status', 'x_mm', 'y_mm', 'z_mm'],
+                                      defaults=(None, None, None))
+
+# Commands sent once per tick. Each is broadcast to every device on the port, so one
+# round trip collects the replies from both controllers.
+POLL_COMMANDS = ("get pos", "io get di", "io get do")
+
+
+class CommandLatency:
+    '''
+    CommandLatency: Running count / mean / max of the round-trip time of one command.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def add(self, latency_s):
+        self.count += 1
+        self.total_s += latency_s
+        self.max_s = max(self.max_s, latency_s)
+
+    def mean_s(self):
+        return self.total_s / self.count if self.count else 0.0
+
+
+class BatchedPoller:
+    '''
+    BatchedPoller: Reads every axis position and every digital I/O line on the port in
+                   three broadcast round trips ("get pos", "io get di", "io get do")
+                   instead of one blocking call per axis and per I/O bank.
+
+    axis_map maps 'x'/'y'/'z' to (device address, axis number). With units (a
+    units.AxisUnits read at connect), each snapshot also carries the positions in mm.
+    '''
+    def __init__(self, connection, axis_map=None, xy_device=1, z_device=2, rate_window=20, units=None):
+        self.connection = connection
+        self.units = units
+        self.axis_map = axis_map or {'x': (1, 1), 'y': (1, 2), 'z': (2, 1)}
+        self.xy_device = xy_device
+        self.z_device = z_device
+        self.device_addresses = sorted(set([xy_device, z_device] +
+                                           [address for address, _ in self.axis_map.values()]))
+        self.latency = dict((command, CommandLatency()) for command in POLL_COMMANDS)
+        self.tick_times = collections.deque(maxlen=rate_window)
+        self.stats_lock = threading.Lock()
+        self.last_snapshot = None
+
+    def send(self, command):
+        '''
+        send(): Broadcast one command and return {device address: reply} for the devices
+                this poller cares about.
+        '''
+        start = time.perf_counter()
+        responses = self.connection.generic_command_multi_response(command)
+        latency_s = time.perf_counter() - start
+        with self.stats_lock:
+            self.latency[command].add(latency_s)
+        replies = dict((response.device_address, response) for response in responses)
+        missing = [address for address in self.device_addresses if address not in replies]
+        if missing:
+            raise RuntimeError("No reply to '%s' from device(s) %s" % (command, missing))
+        return replies
+
+    def poll(self):
+        '''
+        poll(): Take one snapshot of the whole transfer system.
+        '''
+        position_replies = self.send("get pos")
+        input_replies = self.send("io get di")
+        output_replies = self.send("io get do")
+        timestamp = time.monotonic()
+
+        positions = {}
+        for axis_name, (address, axis_number) in self.axis_map.items():
+            positions[axis_name] = int(float(position_replies[address].data.split()[axis_number - 1]))
+        if self.units is not None:
+            x_mm, y_mm, z_mm = self.units.snapshot_mm(positions['x'], positions['y'], positions['z'])
+        else:
+            x_mm = y_mm = z_mm = None
+
+        snapshot = PollSnapshot(timestamp=timestamp,
+                                x=positions['x'],
+                                y=positions['y'],
+                                z=positions['z'],
+                                xy_inputs=self.parse_io(input_replies[self.xy_device]),
+                                xy_outputs=self.parse_io(output_replies[self.xy_device]),
+                                z_inputs=self.parse_io(input_replies[self.z_device]),
+                                z_outputs=self.parse_io(output_replies[self.z_device]),
+                                device_status=dict((address, reply.status)
+                                                   for address, reply in position_replies.items()),
+                                x_mm=x_mm, y_mm=y_mm, z_mm=z_mm)
+        with self.stats_lock:
+            self.tick_times.append(timestamp)
+        self.last_snapshot = snapshot
+        return snapshot
+
+    @staticmethod
+    def parse_io(reply):
+        return tuple(value == '1' for value in reply.data.split())
+
+    def poll_rate_hz(self):
+        '''
+        poll_rate_hz(): Achieved poll rate over the last few ticks.
+        '''
+        with self.stats_lock:
+            if len(self.tick_times) < 2:
+                return 0.0
+            return (len(self.tick_times) - 1) / (self.tick_times[-1] - self.tick_times[0])
+
+    def stats(self):
+        with self.stats_lock:
+            latency = dict((command, {"count": entry.count,
+                                      "mean_ms": entry.mean_s() * 1000,
+                                      "max_ms": entry.max_s * 1000})
+                           for command, entry in self.latency.items())
+        return {"poll_rate_hz": self.poll_rate_hz(), "latency": latency}
@@ -0,0 +1,68 @@
+'''
+bench_multi_cell.py: Load test for running several transfer cells from one daemon.
+                     Runs 1, 2, 4, ... simulated cells side by side in auto mode and
+                     reports the per-cell cycle time at each cell count; it should stay
+                     flat as cells are added.
+
+At high time scales every cell polls many times a second of wall time and the host
+CPU, not the cells, becomes the limit; keep time_scale around 10 for 8 cells.
+
+    python bench_multi_cell.py [max_cells] [samples_per_cell] [time_scale]
+'''
+import sys
+import time
+
+import transfer_cells
+
+
+def run_cells(cell_count, samples, time_scale):
+    configs = [{"name": "bench%d" % index, "port": "SIM@%g" % time_scale,
+                "positions_file": transfer_cells.cell_files(transfer_cells.DEFAULT_CELL)[0],
+                "trace_file": None}
+               for index in range(cell_count)]
+    cells = transfer_cells.CellManager(configs)
+    try:
+        errors = cells.connect_all()
+        if errors:
+            raise RuntimeError("cells failed to connect: %s" % errors)
+        controllers = [cells.cell(name) for name in cells.names()]
+        for controller in controllers:
+            controller.motion_planner.log = None
+        for controller in controllers:
+            controller.homing_thread.join()
+            controller.set_auto_mode(True)
+        machines = [controller.transfer_machine for controller in controllers]
+        wall_start = time.monotonic()
+        while min(len(machine.cycle_times) for machine in machines) < samples:
+            time.sleep(0.05)
+        wall_s = time.monotonic() - wall_start
+        aggregate = cells.status()
+    finally:
+        cells.close()
+
+    cycle_times = [cycle_time for machine in machines for cycle_time in machine.cycle_times[:samples]]
+    mean_s = sum(cycle_times) / len(cycle_times)
+    print("%2d cells: mean %.2f s, max %.2f s per sample per cell; %d cycles total, "
+          "%.1f samples/hour for the daemon (wall %.1f s)" %
+          (cell_count, mean_s, max(cycle_times), aggregate["cycles_completed"],
+           aggregate["cycles_completed"] / (wall_s * time_scale) * 3600, wall_s))
+    return mean_s
+
+
+def run_benchmark(max_cells=8, samples=3, time_scale=10.0):
+    results = {}
+    cell_count = 1
+    while cell_count <= max_cells:
+        results[cell_count] = run_cells(cell_count, samples, time_scale)
+        cell_count *= 2
+    baseline = results[1]
+    for cell_count, mean_s in sorted(results.items()):
+        print("%2d cells: per-cell cycle time %+.1f%% vs 1 cell" % (cell_count, (mean_s / baseline - 1) * 100))
+    return results
+
+
+if __name__ == '__main__':
+    max_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    time_scale = float(sys.argv[3]) if len(sys.argv) > 3 else 10.0
+    run_benchmark(max_cells, samples, time_scale)
@@ -0,0 +1,60 @@
+'''
+bench_position_index.py: Compares PositionIndex against the hand-unrolled per-station range
+                         checks start_polling_axes used to do, for a growing number of
+                         taught stations.
+
+    python bench_position_index.py
+'''
+import random
+import timeit
+
+import position_index
+
+FUZZ_FACTOR_STEPS = 200
+
+
+def legacy_match_all(positions, x, y, z):
+    # One 3-axis block per station, as the old poll loop had
+    matched = []
+    for name, position in positions.items():
+        if ((position["xpos"] - FUZZ_FACTOR_STEPS) <= x < (position["xpos"] + FUZZ_FACTOR_STEPS) and
+                (position["ypos"] - FUZZ_FACTOR_STEPS) <= y < (position["ypos"] + FUZZ_FACTOR_STEPS) and
+                (position["zpos"] - FUZZ_FACTOR_STEPS) <= z < (position["zpos"] + FUZZ_FACTOR_STEPS)):
+            matched.append(name)
+    return matched
+
+
+def make_positions(count, rng):
+    positions = {"home": dict(position_index.HOME_POSITION)}
+    for i in range(count - 1):
+        positions["station_%d" % i] = {"xpos": rng.randrange(0, 300000),
+                                       "ypos": rng.randrange(0, 300000),
+                                       "zpos": rng.randrange(0, 1100000)}
+    return positions
+
+
+def run_benchmark(station_counts=(4, 16, 64, 256), lookups=20000):
+    rng = random.Random(1)
+    for count in station_counts:
+        positions = make_positions(count, rng)
+        index = position_index.PositionIndex(positions, include_home=False)
+        names = list(positions)
+        # Half the queries land on a station, half are in free space
+        queries = []
+        for i in range(lookups):
+            if i % 2:
+                position = positions[rng.choice(names)]
+                queries.append((position["xpos"] + 50, position["ypos"] - 50, position["zpos"]))
+            else:
+                queries.append((rng.randrange(0, 300000), rng.randrange(0, 300000), rng.randrange(0, 1100000)))
+        for x, y, z in queries[:1000]:
+            assert sorted(index.match_all(x, y, z)) == sorted(legacy_match_all(positions, x, y, z))
+
+        legacy_s = timeit.timeit(lambda: [legacy_match_all(positions, x, y, z) for x, y, z in queries], number=1)
+        index_s = timeit.timeit(lambda: [index.match_all(x, y, z) for x, y, z in queries], number=1)
+        print("%4d stations: legacy %.2f us/lookup, index %.2f us/lookup (%.1fx)" %
+              (count, legacy_s / lookups * 1e6, index_s / lookups * 1e6, legacy_s / index_s))
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,59 @@
+'''
+bench_transfer_cycle.py: Runs the transfer controller in auto mode against the hardware
+                         simulator and reports the cycle time per sample and the
+                         throughput in samples/hour (both in simulated time).
+
+    python bench_transfer_cycle.py [samples] [time_scale] [scan_error_rate]
+
+The per-phase breakdown is in transfer_trace.jsonl; see trace_report.py.
+'''
+import sys
+import time
+
+import transfer_core
+import zaber_simulator
+
+
+def run_benchmark(samples=20, time_scale=50.0, fast_poll_ms=50, scan_error_rate=0.0):
+    controller = transfer_core.TransferController(fast_poll_ms=fast_poll_ms)
+    controller.connect("SIM@%g" % time_scale)
+    controller.motion_planner.log = None
+    for peer in controller.zaber_ascii_connection.peers:
+        if isinstance(peer, zaber_simulator.SrasPeer):
+            peer.error_rate = scan_error_rate
+    controller.homing_thread.join()
+    controller.set_auto_mode(True)
+    machine = controller.transfer_machine
+
+    wall_start = time.monotonic()
+    reported = 0
+    try:
+        while len(machine.cycle_times) < samples:
+            time.sleep(0.05)
+            while reported < len(machine.cycle_times):
+                print("sample %d: %.2f s" % (reported + 1, machine.cycle_times[reported]))
+                reported += 1
+    finally:
+        wall_s = time.monotonic() - wall_start
+        controller.close()
+
+    cycle_times = machine.cycle_times[:samples]
+    mean_s = sum(cycle_times) / len(cycle_times)
+    print("%d samples at %gx: mean %.2f s, min %.2f s, max %.2f s per sample -> %.1f samples/hour" %
+          (len(cycle_times), time_scale, mean_s, min(cycle_times), max(cycle_times), 3600 / mean_s))
+    print("wall time %.1f s; end-to-end throughput including idle between cycles: %.1f samples/hour" %
+          (wall_s, len(machine.cycle_times) / (wall_s * time_scale) * 3600))
+    print("scan errors recovered: %d" % machine.scan_errors)
+    print("digital output writes: %(issued)d issued, %(suppressed)d suppressed" %
+          controller.xy_outputs.write_counts())
+    print("poll rate %.1f Hz (wall clock)" % controller.axis_poller.poll_rate_hz())
+    print("polling: %(fast_ticks)d fast ticks, %(slow_ticks)d slow ticks, poll bus occupancy %(bus_occupancy).1f%%" %
+          dict(controller.poll_rate.stats(), bus_occupancy=controller.poll_rate.stats()["bus_occupancy"] * 100))
+    return cycle_times
+
+
+if __name__ == '__main__':
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    time_scale = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+    scan_error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    run_benchmark(samples, time_scale, scan_error_rate=scan_error_rate)
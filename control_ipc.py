@@ -0,0 +1,274 @@
+'''
+control_ipc.py: Local status / command interface to a TransferController.
+
+Messages are newline-delimited JSON over TCP on localhost.
+    request:  {"id": 1, "cmd": "connect", "args": {"port": "COM3", "cell": "cell1"}}
+    reply:    {"id": 1, "ok": true, "result": {...}}  or  {"id": 1, "ok": false, "error": "..."}
+    event:    {"event": "snapshot", "data": {...}}    (only after a "subscribe" request)
+
+Events are "snapshot", "status_message", "positions" (the active recipe's stations,
+sent whenever they are saved, reverted or the recipe is switched), "ports" (port
+discovery results) and "connection" ({"system_state": .., "comport": ..}, after every
+connect and disconnect, including a background auto-connect). Each event message
+also carries the name of the cell it came from in "cell".
+
+Commands in COMMANDS act on the cell named by the optional "cell" argument (the default
+cell without one); those in CELL_COMMANDS act on the daemon's set of cells. "subscribe"
+follows one cell, or every cell with {"cell": "*"}. Commands that take positions, a
+tolerance or a move accept "unit": "counts" (the default) or "mm". Requests on one
+connection run in order, except "stop", which runs as soon as it arrives.
+'''
+import itertools
+import json
+import queue
+import socket
+import socketserver
+import threading
+
+import units
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 47100
+
+# Events queued per subscriber before new snapshots start being dropped for that client
+SUBSCRIBER_QUEUE_DEPTH = 64
+
+COMMANDS = {
+    "status": lambda controller, args: controller.status(),
+    "list_ports": lambda controller, args: controller.list_ports(),
+    "connect": lambda controller, args: controller.connect(args["port"]),
+    "disconnect": lambda controller, args: controller.disconnect(),
+    "stop": lambda controller, args: controller.stop_motion(),
+    "set_auto_mode": lambda controller, args: controller.set_auto_mode(args["enabled"]),
+    "get_positions": lambda controller, args: controller.get_positions(args.get("unit", units.COUNTS)),
+    "set_positions": lambda controller, args: controller.save_positions(args["positions"], args.get("recipe"),
+                                                                         args.get("note"),
+                                                                         args.get("unit", units.COUNTS)),
+    "set_tolerance": lambda controller, args: controller.set_position_tolerance(args["tolerance"],
+                                                                                args.get("unit", units.COUNTS)),
+    "move_axis": lambda controller, args: controller.move_axis(args["axis"], args["position"],
+                                                               args.get("unit", units.COUNTS)),
+    "set_homing_stages": lambda controller, args: controller.set_homing_stages(args.get("stages")),
+    "reload_positions": lambda controller, args: controller.reload_positions(),
+    "position_history": lambda controller, args: controller.position_store.history(args.get("recipe")),
+    "revert_positions": lambda controller, args: controller.position_store.revert(args["version"],
+                                                                                  args.get("recipe")),
+    "list_recipes": lambda controller, args: controller.position_store.recipe_names(),
+    "create_recipe": lambda controller, args: controller.position_store.create_recipe(args["name"],
+                                                                                      args.get("positions")),
+    "delete_recipe": lambda controller, args: controller.position_store.delete_recipe(args["name"]),
+    "select_recipe": lambda controller, args: controller.position_store.select_recipe(args["name"]),
+}
+
+CELL_COMMANDS = {
+    "cells": lambda cells, args: cells.status(),
+    "add_cell": lambda cells, args: cells.add_cell(**args["config"]),
+    "remove_cell": lambda cells, args: cells.remove_cell(args["name"]),
+    "connect_all": lambda cells, args: cells.connect_all(),
+    "discover_ports": lambda cells, args: cells.discover_ports(),
+}
+
+# Run on their own thread as soon as they arrive, so they never wait behind a blocking
+# request (e.g. a move_axis) sent earlier on the same connection
+IMMEDIATE_COMMANDS = ("stop",)
+
+# "subscribe" cell argument that follows every cell
+ALL_CELLS = '*'
+
+
+class ControlError(Exception):
+    '''
+    ControlError: A command was rejected or failed inside the daemon.
+    '''
+    pass
+
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    '''
+    ControlRequestHandler: Serves one client connection. This thread only reads; requests
+                           run in order on a worker thread ("stop" on a thread of its
+                           own) and subscribed events are queued and written by a separate
+                           sender thread so a slow client can never stall the poller.
+    '''
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.write_lock = threading.Lock()
+        self.event_queue = None
+        self.listener = None
+
+    def send(self, message):
+        with self.write_lock:
+            self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+    def queue_event(self, cell, event, data):
+        try:
+            self.event_queue.put_nowait({"event": event, "cell": cell, "data": data})
+        except queue.Full:
+            pass
+
+    def send_events(self):
+        while True:
+            message = self.event_queue.get()
+            if message is None:
+                return
+            try:
+                self.send(message)
+            except (OSError, ValueError):
+                return
+
+    def handle(self):
+        # Requests run in order on one worker thread, so this reader is always free to
+        # pick up a stop while e.g. a move_axis is still running
+        requests = queue.Queue()
+        worker = threading.Thread(None, self.serve_requests, args=(requests,), daemon=True)
+        worker.start()
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            if isinstance(request, dict) and request.get("cmd") in IMMEDIATE_COMMANDS:
+                threading.Thread(None, self.serve_request, args=(line,), daemon=True).start()
+            else:
+                requests.put(line)
+        requests.put(None)
+        worker.join()
+
+    def serve_requests(self, requests):
+        while True:
+            line = requests.get()
+            if line is None or not self.serve_request(line):
+                return
+
+    def serve_request(self, line):
+        '''
+        serve_request(): Run one request line and send its reply. Returns False once the
+                         client has gone away.
+        '''
+        cells = self.server.cells
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            command = request["cmd"]
+            args = request.get("args", {})
+            if command == "subscribe":
+                result = self.subscribe(cells, args.get("cell"))
+            elif command in CELL_COMMANDS:
+                result = CELL_COMMANDS[command](cells, args)
+            elif command in COMMANDS:
+                result = COMMANDS[command](cells.cell(args.get("cell")), args)
+            else:
+                raise ControlError("Unknown command: %s" % command)
+            reply = {"id": request_id, "ok": True, "result": result}
+        except Exception as error:
+            reply = {"id": request_id, "ok": False, "error": "%s: %s" % (type(error).__name__, error)}
+        try:
+            self.send(reply)
+        except (OSError, ValueError):
+            # ValueError: the connection was already closed
+            return False
+        return True
+
+    def subscribe(self, cells, name=None):
+        if self.listener is None:
+            self.event_queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_DEPTH)
+            self.listener = self.queue_event
+            threading.Thread(None, self.send_events, daemon=True).start()
+            cells.add_listener(self.listener, None if name == ALL_CELLS else cells.cell(name).name)
+        if name == ALL_CELLS:
+            return cells.status()
+        return cells.cell(name).status()
+
+    def finish(self):
+        if self.listener is not None:
+            self.server.cells.remove_listener(self.listener)
+            self.event_queue.put(None)
+        socketserver.StreamRequestHandler.finish(self)
+
+
+class ControlServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, cells, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.cells = cells
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), ControlRequestHandler)
+
+    def start(self):
+        '''
+        start(): Serve in a background thread.
+        '''
+        self.thread = threading.Thread(None, self.serve_forever, daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+class ControlClient:
+    '''
+    ControlClient: Blocking request/reply client for a ControlServer. Events from a
+                   subscription are passed to on_event(event, data) on the reader thread.
+                   With a cell name, every request is addressed to that cell.
+    '''
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_event=None, timeout_s=30.0, cell=None):
+        self.on_event = on_event
+        self.cell = cell
+        self.timeout_s = timeout_s
+        self.socket = socket.create_connection((host, port), timeout=timeout_s)
+        self.socket.settimeout(None)
+        self.reader = self.socket.makefile('rb')
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.reader_thread = threading.Thread(None, self.read_messages, daemon=True)
+        self.reader_thread.start()
+
+    def read_messages(self):
+        for line in self.reader:
+            message = json.loads(line)
+            if "event" in message:
+                if self.on_event is not None:
+                    self.on_event(message["event"], message["data"])
+                continue
+            with self.pending_lock:
+                reply_queue = self.pending.pop(message.get("id"), None)
+            if reply_queue is not None:
+                reply_queue.put(message)
+        # Connection closed; release anyone still waiting
+        with self.pending_lock:
+            for reply_queue in self.pending.values():
+                reply_queue.put({"ok": False, "error": "Connection to daemon closed"})
+            self.pending.clear()
+
+    def request(self, command, **args):
+        if self.cell is not None and command not in CELL_COMMANDS:
+            args.setdefault("cell", self.cell)
+        request_id = next(self.request_ids)
+        reply_queue = queue.Queue(maxsize=1)
+        with self.pending_lock:
+            self.pending[request_id] = reply_queue
+        with self.write_lock:
+            self.socket.sendall((json.dumps({"id": request_id, "cmd": command, "args": args}) + '\n').encode('utf-8'))
+        try:
+            reply = reply_queue.get(timeout=self.timeout_s)
+        except queue.Empty:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise ControlError("No reply to '%s' within %.0f s" % (command, self.timeout_s))
+        if not reply["ok"]:
+            raise ControlError(reply["error"])
+        return reply["result"]
+
+    def subscribe(self):
+        return self.request("subscribe")
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
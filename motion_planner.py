@@ -0,0 +1,162 @@
+import threading
+import time
+
+
+class MotionAborted(Exception):
+    '''
+    MotionAborted: Raised instead of sending the next move once the planner was aborted.
+    '''
+    pass
+
+
+def check_homing_stages(stages):
+    '''
+    check_homing_stages(): Raise ValueError unless stages is a list of groups of axis
+                           names that homes each of x, y and z exactly once.
+    '''
+    names = [axis_name for stage in stages for axis_name in stage]
+    if sorted(names) != ['x', 'y', 'z'] or not all(stages):
+        raise ValueError("Homing stages must home each of x, y and z exactly once, got %r" % (stages,))
+    return [list(stage) for stage in stages]
+
+
+class MotionPlanner:
+    '''
+    MotionPlanner: Moves the transfer stages to named stations.
+
+    X and Y are commanded at the same time and waited on together, so lateral travel
+    takes as long as the slower axis instead of the sum of both. Z keeps the ordering the
+    transfer sequence relies on: it retracts to the safe height before any lateral travel
+    and only descends to the station height once X and Y have arrived.
+
+    Every move records how long each axis took on its own; the sum of those is what the
+    old one-axis-after-another sequence would have cost, and the difference is logged as
+    the time saved.
+
+    abort() makes every following move raise MotionAborted until resume(), so a stop in
+    the middle of a multi-step move doesn't carry on with the next step.
+    '''
+    def __init__(self, x_axis, y_axis, z_axis, get_positions, z_safe_height=0, log=print):
+        self.axes = {'x': x_axis, 'y': y_axis, 'z': z_axis}
+        self.get_positions = get_positions
+        self.z_safe_height = z_safe_height
+        self.log = log
+        self.total_saved_s = 0.0
+        self.move_count = 0
+        self.aborted = threading.Event()
+
+    def abort(self):
+        self.aborted.set()
+
+    def resume(self):
+        self.aborted.clear()
+
+    def check_aborted(self):
+        if self.aborted.is_set():
+            raise MotionAborted()
+
+    def run_on_axes_together(self, actions):
+        '''
+        run_on_axes_together(): Run a blocking call on several axes at once
+                                ({axis name: callable taking the axis}) and wait for all
+                                of them. Returns {axis name: seconds that call took}.
+        '''
+        durations = {}
+        errors = []
+
+        def run_action(axis_name, action):
+            start = time.monotonic()
+            try:
+                action(self.axes[axis_name])
+            except Exception as error:
+                errors.append(error)
+            durations[axis_name] = time.monotonic() - start
+
+        threads = [threading.Thread(None, run_action, args=(axis_name, action), daemon=True)
+                   for axis_name, action in actions.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return durations
+
+    def move_axes_together(self, targets):
+        '''
+        move_axes_together(): Start an absolute move on every axis in targets
+                              ({'x': counts, ...}) at once and block until all are idle.
+                              Returns {axis name: seconds that axis was moving}.
+        '''
+        self.check_aborted()
+        return self.run_on_axes_together(
+            dict((axis_name, lambda axis, position=position: axis.move_absolute(position, wait_until_idle=True))
+                 for axis_name, position in targets.items()))
+
+    def homing_stages(self, z_safe_tolerance=200):
+        '''
+        homing_stages(): Default homing order. Everything homes at once when Z is homed and
+                         at the safe height; otherwise Z has to finish homing before X/Y
+                         are allowed to travel. The position of an axis that isn't homed
+                         (e.g. after power-up) means nothing, so it never counts as safe.
+        '''
+        try:
+            z_is_safe = (self.axes['z'].is_homed() and
+                         abs(self.axes['z'].get_position() - self.z_safe_height) <= z_safe_tolerance)
+        except Exception:
+            z_is_safe = False
+        if z_is_safe:
+            return [['x', 'y', 'z']]
+        return [['z'], ['x', 'y']]
+
+    def home_all(self, stages=None, on_stage=None):
+        '''
+        home_all(): Home every axis. stages is a list of groups of axis names; the axes in
+                    one group home in parallel and each group waits for the previous one,
+                    e.g. [['z'], ['x', 'y']]. Returns the time-to-ready in seconds.
+        '''
+        if stages is None:
+            stages = self.homing_stages()
+        start = time.monotonic()
+        sequential_s = 0.0
+        for stage in stages:
+            self.check_aborted()
+            if on_stage is not None:
+                on_stage(stage)
+            durations = self.run_on_axes_together(
+                dict((axis_name, lambda axis: axis.home(wait_until_idle=True)) for axis_name in stage))
+            sequential_s += sum(durations.values())
+        ready_s = time.monotonic() - start
+        if self.log is not None:
+            self.log("homing %s: ready in %.2f s, saved %.2f s vs sequential" %
+                     (stages, ready_s, max(0.0, sequential_s - ready_s)))
+        return ready_s
+
+    def move_axis(self, axis_name, position):
+        self.check_aborted()
+        start = time.monotonic()
+        self.axes[axis_name].move_absolute(position, wait_until_idle=True)
+        return time.monotonic() - start
+
+    def move_to_station(self, station, z_safe=True):
+        '''
+        move_to_station(): Move to a taught station. With z_safe, Z first retracts to the
+                           safe height, X/Y then travel together, and Z finally descends.
+        '''
+        position = self.get_positions()[station]
+        start = time.monotonic()
+        sequential_s = 0.0
+        if z_safe:
+            sequential_s += self.move_axis('z', self.z_safe_height)
+        durations = self.move_axes_together({'x': position["xpos"], 'y': position["ypos"]})
+        sequential_s += sum(durations.values())
+        sequential_s += self.move_axis('z', position["zpos"])
+        elapsed_s = time.monotonic() - start
+
+        saved_s = max(0.0, sequential_s - elapsed_s)
+        self.total_saved_s += saved_s
+        self.move_count += 1
+        if self.log is not None:
+            self.log("move to %s: %.2f s, saved %.2f s vs sequential (total saved %.1f s)" %
+                     (station, elapsed_s, saved_s, self.total_saved_s))
+        return elapsed_s
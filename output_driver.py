@@ -0,0 +1,50 @@
+import threading
+
+
+class DigitalOutputDriver:
+    '''
+    DigitalOutputDriver: Edge-triggered wrapper around a Zaber DeviceIO's digital outputs.
+
+    Remembers the last state commanded on each output and only sends a command over the
+    serial line when the requested value differs from it. Keeps the same
+    set_digital_output / set_all_digital_outputs calls as DeviceIO so it can be handed to
+    anything that expects the device's io object.
+    '''
+    def __init__(self, device_io, channel_count=4):
+        self.device_io = device_io
+        self.channel_count = channel_count
+        self.lock = threading.Lock()
+        # None means "unknown", which always forces the next write through
+        self.commanded = [None] * channel_count
+        self.issued_writes = 0
+        self.suppressed_writes = 0
+
+    def set_digital_output(self, channel, value):
+        '''
+        set_digital_output(): Drive one output (1-based channel). Returns True when a
+                              command was actually sent to the device.
+        '''
+        value = bool(value)
+        with self.lock:
+            if self.commanded[channel - 1] == value:
+                self.suppressed_writes += 1
+                return False
+            self.device_io.set_digital_output(channel, value)
+            self.commanded[channel - 1] = value
+            self.issued_writes += 1
+            return True
+
+    def set_all_digital_outputs(self, values):
+        values = [bool(value) for value in values]
+        with self.lock:
+            if self.commanded == values:
+                self.suppressed_writes += 1
+                return False
+            self.device_io.set_all_digital_outputs(values)
+            self.commanded = values
+            self.issued_writes += 1
+            return True
+
+    def write_counts(self):
+        with self.lock:
+            return {"issued": self.issued_writes, "suppressed": self.suppressed_writes}
@@ -0,0 +1,73 @@
+import collections
+import threading
+
+# Poll period bounds. Fast while anything moves or a handshake input is awaited, slow
+# heartbeat otherwise.
+FAST_POLL_MS = 50
+SLOW_POLL_MS = 1000
+# Stay fast this long after the last busy axis, to catch a follow-up move
+BUSY_LINGER_S = 0.5
+# Device status reported by the "get pos" reply while an axis is moving
+BUSY_STATUS = 'BUSY'
+
+
+class AdaptivePollRate:
+    '''
+    AdaptivePollRate: Picks the delay before the next poll tick from the last snapshot.
+
+    Polls every fast_ms while any device reports BUSY (the status field of the "get pos"
+    reply, so deciding costs no extra command), while a handshake input is expected, and
+    for linger_s after the last busy tick; otherwise every slow_ms. Bounds are in real
+    milliseconds and are divided by time_scale on a simulated port.
+
+    Keeps the achieved poll rate and the share of wall time the poll commands held the
+    port (bus occupancy) over the last window ticks.
+    '''
+    def __init__(self, fast_ms=FAST_POLL_MS, slow_ms=SLOW_POLL_MS, linger_s=BUSY_LINGER_S,
+                 time_scale=1.0, window=50):
+        if not 0 < fast_ms <= slow_ms:
+            raise ValueError("Poll bounds must satisfy 0 < fast_ms <= slow_ms, got %s / %s" % (fast_ms, slow_ms))
+        self.fast_s = fast_ms / 1000 / time_scale
+        self.slow_s = slow_ms / 1000 / time_scale
+        self.linger_s = linger_s / time_scale
+        self.time_scale = time_scale
+        self.last_busy = None
+        self.fast = False
+        self.fast_ticks = 0
+        self.slow_ticks = 0
+        # (tick start, time spent polling) per tick
+        self.ticks = collections.deque(maxlen=window)
+        self.stats_lock = threading.Lock()
+
+    def next_delay_s(self, snapshot, expecting_handshake, tick_start, poll_duration_s):
+        '''
+        next_delay_s(): Record one tick and return the poll period to use until the next.
+        '''
+        busy = any(status == BUSY_STATUS for status in snapshot.device_status.values())
+        if busy:
+            self.last_busy = tick_start
+        lingering = self.last_busy is not None and tick_start - self.last_busy < self.linger_s
+        with self.stats_lock:
+            self.fast = busy or expecting_handshake or lingering
+            if self.fast:
+                self.fast_ticks += 1
+            else:
+                self.slow_ticks += 1
+            self.ticks.append((tick_start, poll_duration_s))
+        return self.fast_s if self.fast else self.slow_s
+
+    def stats(self):
+        with self.stats_lock:
+            ticks = list(self.ticks)
+            stats = {"mode": "fast" if self.fast else "slow",
+                     "fast_ms": self.fast_s * 1000 * self.time_scale,
+                     "slow_ms": self.slow_s * 1000 * self.time_scale,
+                     "fast_ticks": self.fast_ticks,
+                     "slow_ticks": self.slow_ticks,
+                     "poll_rate_hz": 0.0,
+                     "bus_occupancy": 0.0}
+        if len(ticks) >= 2:
+            span_s = ticks[-1][0] - ticks[0][0]
+            stats["poll_rate_hz"] = (len(ticks) - 1) / span_s
+            stats["bus_occupancy"] = sum(duration for _, duration in ticks[:-1]) / span_s
+        return stats
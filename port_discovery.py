@@ -0,0 +1,156 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import position_store
+import zaber_simulator
+
+DISCOVERY_CACHE_FILE = 'port_discovery.json'
+# Axis count each device address must report for a port to count as a transfer cell
+EXPECTED_AXES = {1: 2, 2: 1}
+# How long a silent (non-Zaber) port gets to answer before it is written off
+PROBE_TIMEOUT_MS = 300
+
+
+def serial_port_names():
+    '''
+    serial_port_names(): The device name of every serial port on this machine.
+    '''
+    import serial.tools.list_ports
+    return [current_port.device for current_port in serial.tools.list_ports.comports()]
+
+
+def open_port(port):
+    if zaber_simulator.is_simulated_port(port):
+        return zaber_simulator.SimulatedConnection.open_serial_port(port)
+    from zaber_motion.ascii import Connection
+    return Connection.open_serial_port(port)
+
+
+def read_axis_counts(connection, timeout_ms=PROBE_TIMEOUT_MS):
+    '''
+    read_axis_counts(): {device address: axis count} of every device answering on an open
+                        connection, from one broadcast.
+    '''
+    responses = connection.generic_command_multi_response("get system.axiscount", timeout=timeout_ms)
+    return dict((response.device_address, int(response.data)) for response in responses)
+
+
+def probe_port(port, expected_axes=EXPECTED_AXES, timeout_ms=PROBE_TIMEOUT_MS):
+    '''
+    probe_port(): Open port, ask every device for its axis count with one broadcast and
+                  close it again. Returns a result dict; "zaber" is True only when every
+                  expected device answered with at least the expected number of axes.
+    '''
+    result = {"zaber": False, "devices": {}, "error": None, "probed_at": time.time()}
+    start = time.perf_counter()
+    try:
+        connection = open_port(port)
+        try:
+            axis_counts = read_axis_counts(connection, timeout_ms)
+        finally:
+            connection.close()
+        result["devices"] = dict(("%d" % address, axes) for address, axes in axis_counts.items())
+        result["zaber"] = all(result["devices"].get("%d" % address, 0) >= axes
+                              for address, axes in expected_axes.items())
+        if not result["zaber"]:
+            result["error"] = "Expected devices %s, found %s" % (expected_axes, result["devices"])
+    except Exception as error:
+        result["error"] = "%s: %s" % (type(error).__name__, error)
+    result["probe_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+class PortDiscovery:
+    '''
+    PortDiscovery: Finds the serial ports that have the transfer cell's Zaber controllers
+                   on them, and remembers the port each cell last connected on.
+
+    discover() probes every candidate port at once, each on its own thread, so the whole
+    scan takes about as long as the slowest port. Results and the last good port per cell
+    are kept in DISCOVERY_CACHE_FILE between runs, so at startup a cell can reconnect
+    straight away and the probe only refreshes the list in the background.
+    '''
+    def __init__(self, cache_file=DISCOVERY_CACHE_FILE, expected_axes=EXPECTED_AXES,
+                 list_ports=serial_port_names):
+        self.cache_file = cache_file
+        self.expected_axes = expected_axes
+        self.list_ports = list_ports
+        self.cache_lock = threading.Lock()
+        self.discovery_lock = threading.Lock()
+        self.cache = {"ports": {}, "last_good": {}}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as json_file:
+                    self.cache.update(json.load(json_file))
+            except ValueError as error:
+                print("ignoring unreadable %s: %s" % (self.cache_file, error))
+
+    def save(self):
+        with self.cache_lock:
+            position_store.write_json_atomic(self.cache_file, self.cache)
+
+    def discover(self, skip_ports=()):
+        '''
+        discover(): Probe every serial port except skip_ports (ports this daemon already
+                    has open) in parallel. Returns {port: result}, see probe_port().
+        '''
+        with self.discovery_lock:
+            try:
+                ports = [port for port in self.list_ports() if port not in skip_ports]
+            except Exception as error:
+                print("port discovery: cannot list serial ports: %s" % error)
+                return {}
+            start = time.perf_counter()
+            results = {}
+            if ports:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as executor:
+                    futures = dict((port, executor.submit(probe_port, port, self.expected_axes)) for port in ports)
+                    for port, future in futures.items():
+                        results[port] = future.result()
+            with self.cache_lock:
+                # Ports that have gone away are dropped; ones skipped keep their last result
+                kept = dict((port, result) for port, result in self.cache["ports"].items() if port in skip_ports)
+                kept.update(results)
+                self.cache["ports"] = kept
+            self.save()
+            print("port discovery: %d port(s) probed in %.0f ms, Zaber on %s" %
+                  (len(ports), (time.perf_counter() - start) * 1000,
+                   ", ".join(port for port in ports if results[port]["zaber"]) or "none"))
+            return results
+
+    def discover_in_background(self, on_done=None, skip_ports=()):
+        def run():
+            results = self.discover(skip_ports)
+            if on_done is not None:
+                on_done(results)
+        thread = threading.Thread(None, run, daemon=True)
+        thread.start()
+        return thread
+
+    def zaber_ports(self):
+        '''
+        zaber_ports(): Ports with the expected controllers, according to the last probe.
+        '''
+        with self.cache_lock:
+            return sorted(port for port, result in self.cache["ports"].items() if result["zaber"])
+
+    def port_results(self):
+        with self.cache_lock:
+            return dict(self.cache["ports"])
+
+    def last_good_port(self, cell):
+        with self.cache_lock:
+            return self.cache["last_good"].get(cell)
+
+    def remember(self, cell, port):
+        '''
+        remember(): Record that cell connected on port, for the next startup.
+        '''
+        with self.cache_lock:
+            if self.cache["last_good"].get(cell) == port:
+                return
+            self.cache["last_good"][cell] = port
+        self.save()
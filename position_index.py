@@ -0,0 +1,49 @@
+import array
+import bisect
+
+# Default per-axis match window in counts, the old fuzz_factor_steps
+DEFAULT_TOLERANCE_STEPS = (200, 200, 200)
+HOME_POSITION = {"xpos": 0, "ypos": 0, "zpos": 0}
+
+
+class PositionIndex:
+    '''
+    PositionIndex: Answers "which taught station are the stages at?" for any number of
+                   stations.
+
+    Station coordinates are kept in flat arrays sorted by X. A lookup bisects the X column
+    to the few stations whose X window contains the current position and only checks Y and
+    Z for those, so the cost barely grows as stations are added.
+
+    A position matches a station when station - tol <= position < station + tol on every
+    axis, the same half-open window the old hand-written checks used.
+    '''
+    def __init__(self, positions, tolerance_steps=DEFAULT_TOLERANCE_STEPS, include_home=True):
+        self.tolerance_steps = tuple(tolerance_steps)
+        stations = dict(positions)
+        if include_home:
+            stations.setdefault("home", HOME_POSITION)
+        ordered = sorted(stations.items(), key=lambda item: item[1]["xpos"])
+        self.names = [name for name, _ in ordered]
+        self.xs = array.array('d', [position["xpos"] for _, position in ordered])
+        self.ys = array.array('d', [position["ypos"] for _, position in ordered])
+        self.zs = array.array('d', [position["zpos"] for _, position in ordered])
+
+    def __len__(self):
+        return len(self.names)
+
+    def match_all(self, x, y, z):
+        '''
+        match_all(): Names of every station whose window contains (x, y, z).
+        '''
+        tol_x, tol_y, tol_z = self.tolerance_steps
+        # x - tol_x < station_x <= x + tol_x
+        first = bisect.bisect_right(self.xs, x - tol_x)
+        last = bisect.bisect_right(self.xs, x + tol_x)
+        matched = []
+        for i in range(first, last):
+            if (self.xs[i] - tol_x <= x < self.xs[i] + tol_x and
+                    self.ys[i] - tol_y <= y < self.ys[i] + tol_y and
+                    self.zs[i] - tol_z <= z < self.zs[i] + tol_z):
+                matched.append(self.names[i])
+        return matched
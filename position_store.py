@@ -0,0 +1,228 @@
+import copy
+import json
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_RECIPE = 'default'
+# Stations every recipe has to teach; the transfer cycle visits all of them
+STATION_NAMES = ("robomet_load", "xz_transfer", "sras_load")
+AXIS_KEYS = ("xpos", "ypos", "zpos")
+FILE_FORMAT = 2
+# Saved versions kept per recipe; the oldest are dropped first
+HISTORY_DEPTH = 50
+
+
+def empty_stations():
+    # Transfer positions. These should always be set to zero until they are taught.
+    return {"robomet_load": {"xpos": 0, "ypos": 0, "zpos": 0},
+            "xz_transfer": {"xpos": 0, "ypos": 0, "zpos": 0},
+            "sras_load": {"xpos": 0, "ypos": 0, "zpos": 0}}
+
+
+def check_stations(stations):
+    '''
+    check_stations(): Raise ValueError unless stations has every station in STATION_NAMES
+                      and every station has whole-number xpos/ypos/zpos counts.
+    '''
+    if not isinstance(stations, dict):
+        raise ValueError("Stations must be a dict, got %r" % (stations,))
+    missing = [station for station in STATION_NAMES if station not in stations]
+    if missing:
+        raise ValueError("Missing station(s): %s" % ", ".join(missing))
+    for station, position in stations.items():
+        if not isinstance(position, dict):
+            raise ValueError("Station %s must be a dict of %s" % (station, "/".join(AXIS_KEYS)))
+        for key in AXIS_KEYS:
+            value = position.get(key)
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError("Station %s: %s must be a whole number of counts, got %r" % (station, key, value))
+    return stations
+
+
+def write_json_atomic(path, data):
+    '''
+    write_json_atomic(): Write data to a temp file next to path and rename it over path,
+                         so a crash mid-write leaves the previous file intact.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            json.dump(data, temp_file, indent=1)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class PositionStore:
+    '''
+    PositionStore: The taught stations, held in memory and persisted to one JSON file.
+
+    Stations are grouped into named recipes ({"robomet_load": {"xpos": .., ...}, ...} per
+    recipe); one recipe is active at a time and can be switched live. Every save of a
+    recipe adds a numbered version to its history, so a bad teach can be reverted.
+
+    The file is read once by load() and rewritten atomically on every change. Listeners
+    registered with add_listener(callback) are called as callback(recipe, stations) on the
+    caller's thread whenever the active stations change. The stations dict handed out is
+    never modified afterwards; a change always replaces it.
+
+    A legacy transfer_positions.json (just the stations dict) loads as the "default" recipe.
+    Stations are checked with check_stations() before they are stored or loaded, so a bad
+    save is refused and never reaches the file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.active_recipe = DEFAULT_RECIPE
+        self.recipes = {DEFAULT_RECIPE: self.new_recipe(empty_stations(), "created")}
+
+    def new_recipe(self, stations, note):
+        return {"version": 1,
+                "stations": copy.deepcopy(stations),
+                "history": [{"version": 1, "saved_at": time.time(), "note": note,
+                             "stations": copy.deepcopy(stations)}]}
+
+    def add_listener(self, callback):
+        with self.lock:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.lock:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+    def notify(self):
+        with self.lock:
+            listeners = list(self.listeners)
+            recipe, stations = self.active_recipe, self.stations()
+        for callback in listeners:
+            callback(recipe, stations)
+
+    def load(self):
+        '''
+        load(): Read the file into memory. Returns False, and writes the current (empty)
+                stations out, when the file does not exist yet.
+        '''
+        with self.lock:
+            if not os.path.exists(self.path):
+                self.persist()
+                found = False
+            else:
+                with open(self.path, 'r') as json_file:
+                    data = json.load(json_file)
+                if data.get("format") == FILE_FORMAT:
+                    recipes, active_recipe = data["recipes"], data["active_recipe"]
+                else:
+                    recipes, active_recipe = {DEFAULT_RECIPE: self.new_recipe(data, "imported")}, DEFAULT_RECIPE
+                if active_recipe not in recipes:
+                    raise ValueError("%s: active recipe %s does not exist" % (self.path, active_recipe))
+                for name, entry in recipes.items():
+                    try:
+                        check_stations(entry["stations"])
+                    except ValueError as error:
+                        raise ValueError("%s: recipe %s: %s" % (self.path, name, error))
+                self.recipes, self.active_recipe = recipes, active_recipe
+                found = True
+        self.notify()
+        return found
+
+    def persist(self):
+        write_json_atomic(self.path, {"format": FILE_FORMAT,
+                                      "active_recipe": self.active_recipe,
+                                      "recipes": self.recipes})
+
+    def stations(self, recipe=None):
+        with self.lock:
+            return self.recipes[recipe or self.active_recipe]["stations"]
+
+    def recipe_names(self):
+        with self.lock:
+            return sorted(self.recipes)
+
+    def save(self, stations, recipe=None, note=None):
+        '''
+        save(): Store stations as the next version of recipe (the active one by default).
+                Returns the new version number.
+        '''
+        check_stations(stations)
+        with self.lock:
+            recipe = recipe or self.active_recipe
+            if recipe not in self.recipes:
+                raise KeyError("No recipe named %s" % recipe)
+            entry = self.recipes[recipe]
+            entry["version"] += 1
+            entry["stations"] = copy.deepcopy(stations)
+            entry["history"].append({"version": entry["version"], "saved_at": time.time(),
+                                     "note": note, "stations": copy.deepcopy(stations)})
+            del entry["history"][:-HISTORY_DEPTH]
+            self.persist()
+            version = entry["version"]
+            changed_active = recipe == self.active_recipe
+        if changed_active:
+            self.notify()
+        return version
+
+    def history(self, recipe=None):
+        '''
+        history(): The saved versions of recipe, oldest first, without their stations.
+        '''
+        with self.lock:
+            return [{"version": saved["version"], "saved_at": saved["saved_at"], "note": saved["note"]}
+                    for saved in self.recipes[recipe or self.active_recipe]["history"]]
+
+    def revert(self, version, recipe=None):
+        '''
+        revert(): Save an older version of recipe again as its newest version.
+        '''
+        with self.lock:
+            recipe = recipe or self.active_recipe
+            for saved in self.recipes[recipe]["history"]:
+                if saved["version"] == version:
+                    stations = saved["stations"]
+                    break
+            else:
+                raise KeyError("Recipe %s has no version %d" % (recipe, version))
+        return self.save(stations, recipe, note="revert to version %d" % version)
+
+    def create_recipe(self, name, stations=None):
+        '''
+        create_recipe(): Add a recipe, starting from stations or a copy of the active one.
+        '''
+        with self.lock:
+            if name in self.recipes:
+                raise KeyError("Recipe %s already exists" % name)
+            if stations is not None:
+                check_stations(stations)
+            self.recipes[name] = self.new_recipe(stations if stations is not None else self.stations(),
+                                                 "created")
+            self.persist()
+        return self.recipe_names()
+
+    def delete_recipe(self, name):
+        with self.lock:
+            if name == self.active_recipe:
+                raise ValueError("Cannot delete the active recipe")
+            del self.recipes[name]
+            self.persist()
+        return self.recipe_names()
+
+    def select_recipe(self, name):
+        '''
+        select_recipe(): Make name the active recipe. Takes effect immediately; nothing is
+                         re-read from disk.
+        '''
+        with self.lock:
+            if name not in self.recipes:
+                raise KeyError("No recipe named %s" % name)
+            self.active_recipe = name
+            self.persist()
+        self.notify()
+        return self.stations()
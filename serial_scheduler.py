@@ -0,0 +1,362 @@
+import asyncio
+import bisect
+import concurrent.futures
+import itertools
+import threading
+import time
+
+# Command priorities, lowest number runs first
+PRIORITY_STOP = 0
+PRIORITY_SAFETY_IO = 1
+PRIORITY_MOTION = 2
+PRIORITY_STATUS = 3
+PRIORITY_DISPLAY = 4
+
+# Upper edges (ms) of the latency histogram buckets; the last bucket is open ended
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# How often a queued wait_until_idle re-checks the axis
+IDLE_POLL_S = 0.020
+# How long stop() waits for the final stop_all to reach the port
+STOP_TIMEOUT_S = 2.0
+
+
+class MotionStopped(Exception):
+    '''
+    MotionStopped: A move or home was refused because stop_all() was sent and motion has
+                   not been re-enabled since.
+    '''
+    pass
+
+
+class SchedulerStopped(MotionStopped):
+    '''
+    SchedulerStopped: The scheduler was shut down before the command could run.
+    '''
+    pass
+
+
+class LatencyHistogram:
+    '''
+    LatencyHistogram: Bucketed counts of command round-trip times.
+    '''
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, latency_ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def as_dict(self):
+        count = sum(self.counts)
+        labels = ["<=%d" % edge for edge in LATENCY_BUCKETS_MS] + [">%d" % LATENCY_BUCKETS_MS[-1]]
+        return {"count": count,
+                "mean_ms": self.total_ms / count if count else 0.0,
+                "max_ms": self.max_ms,
+                "buckets_ms": dict(zip(labels, self.counts))}
+
+
+class PortScheduler:
+    '''
+    PortScheduler: Owns one serial port on an asyncio event loop running in its own thread.
+
+    Every command for the port goes through a single priority queue and is executed one at
+    a time, so threads no longer interleave arbitrarily on the connection: stop commands
+    and safety I/O always overtake display polling. Moves are sent without blocking and
+    their completion is awaited with short queued status checks, so a long move never
+    holds the port.
+
+    Coroutine APIs (get_position, get_digital_inputs, set_digital_output, move_absolute,
+    home, stop_all, ...) are for code already running on the loop; submit() and the proxy
+    objects from axis()/device_io()/connection_proxy() let threaded code use the same queue.
+    '''
+    def __init__(self, connection, time_scale=1.0, trace=None):
+        self.connection = connection
+        # Optional TraceLog; every command's queue wait and latency is written to it
+        self.trace = trace
+        # A simulated connection runs faster than real time; re-check idle axes faster to match
+        self.idle_poll_s = IDLE_POLL_S / time_scale
+        self.loop = asyncio.new_event_loop()
+        self.sequence = itertools.count()
+        self.stats_lock = threading.Lock()
+        self.latency = {}
+        self.queue_depth_max = 0
+        # Time the port spent executing commands, for the bus occupancy figure
+        self.busy_s = 0.0
+        self.started_at = time.perf_counter()
+        # Called (on the loop thread) whenever a move or home is sent
+        self.on_motion = None
+        # Cleared by stop_all(); moves and homes are refused until enable_motion()
+        self.motion_enabled = True
+        self.thread = None
+        self.ready = threading.Event()
+        self.closed = False
+        # Future of the command the worker is executing right now
+        self.current_future = None
+
+    def start(self):
+        self.thread = threading.Thread(None, self.run_loop, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.PriorityQueue()
+        self.worker = self.loop.create_task(self.process_queue())
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        '''
+        stop(): Stop every axis, fail every command still waiting (so no caller blocks
+                forever), then shut the loop down.
+        '''
+        if self.thread is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout=2 * STOP_TIMEOUT_S)
+        except Exception as error:
+            print("port scheduler shutdown: %s" % error)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2.0)
+        self.thread = None
+
+    async def shutdown(self):
+        try:
+            await asyncio.wait_for(self.stop_all(), STOP_TIMEOUT_S)
+        except Exception as error:
+            print("stop on shutdown failed: %s" % error)
+        self.closed = True
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        error = SchedulerStopped("Port scheduler stopped")
+        pending = [self.current_future] if self.current_future is not None else []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait()[4])
+        for future in pending:
+            if not future.done():
+                future.set_exception(error)
+        # Coroutines run for other threads (e.g. one sleeping between idle checks)
+        others = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+        for task in others:
+            task.cancel()
+        await asyncio.gather(*others, return_exceptions=True)
+
+    async def process_queue(self):
+        while True:
+            priority, _, name, func, future, queued_at, is_motion = await self.queue.get()
+            if future.cancelled():
+                continue
+            # A move queued before a stop_all() that overtook it must not run after it
+            if is_motion and not self.motion_enabled:
+                future.set_exception(MotionStopped("Motion was stopped before this %s was sent" % name))
+                continue
+            self.current_future = future
+            start = time.perf_counter()
+            try:
+                # The zaber_motion call blocks, so it runs in the executor while the loop
+                # keeps accepting new commands into the queue.
+                result = await self.loop.run_in_executor(None, func)
+            except Exception as error:
+                if not future.cancelled():
+                    future.set_exception(error)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            self.current_future = None
+            latency_ms = (time.perf_counter() - start) * 1000
+            with self.stats_lock:
+                self.latency.setdefault(name, LatencyHistogram()).add(latency_ms)
+                self.busy_s += latency_ms / 1000
+            if self.trace is not None:
+                self.trace.write("command", name=name, priority=priority, latency_ms=latency_ms,
+                                 queued_ms=(start - queued_at) * 1000)
+
+    async def execute(self, priority, name, func, is_motion=False):
+        '''
+        execute(): Queue func() (a blocking call on the connection) and await its result.
+                   An is_motion command is dropped with MotionStopped if stop_all() is sent
+                   before it reaches the port.
+        '''
+        if self.closed:
+            raise SchedulerStopped("Port scheduler stopped")
+        future = self.loop.create_future()
+        self.queue.put_nowait((priority, next(self.sequence), name, func, future, time.perf_counter(), is_motion))
+        with self.stats_lock:
+            self.queue_depth_max = max(self.queue_depth_max, self.queue.qsize())
+        return await future
+
+    def submit(self, priority, name, func):
+        '''
+        submit(): Thread-safe execute(). Blocks the calling thread until the command ran.
+        '''
+        return self.run(self.execute(priority, name, func))
+
+    def run(self, coroutine):
+        '''
+        run(): Run one of the coroutine APIs from another thread and wait for the result.
+               Raises SchedulerStopped if the scheduler shuts down first.
+        '''
+        if self.closed or self.loop.is_closed():
+            coroutine.close()
+            raise SchedulerStopped("Port scheduler stopped")
+        try:
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        except concurrent.futures.CancelledError:
+            raise SchedulerStopped("Port scheduler stopped")
+
+    # Coroutine APIs
+    async def get_position(self, axis, priority=PRIORITY_STATUS):
+        return await self.execute(priority, "get pos", axis.get_position)
+
+    async def get_digital_inputs(self, device, priority=PRIORITY_SAFETY_IO):
+        return await self.execute(priority, "io get di", device.io.get_all_digital_inputs)
+
+    async def get_digital_outputs(self, device, priority=PRIORITY_SAFETY_IO):
+        return await self.execute(priority, "io get do", device.io.get_all_digital_outputs)
+
+    async def set_digital_output(self, device, channel, value, priority=PRIORITY_SAFETY_IO):
+        return await self.execute(priority, "io set do",
+                                  lambda: device.io.set_digital_output(channel, value))
+
+    async def wait_until_idle(self, axis, priority=PRIORITY_STATUS):
+        while await self.execute(priority, "get busy", axis.is_busy):
+            await asyncio.sleep(self.idle_poll_s)
+
+    def check_motion_enabled(self):
+        if not self.motion_enabled:
+            raise MotionStopped("Motion is stopped; re-enable it before moving")
+
+    def enable_motion(self):
+        self.motion_enabled = True
+
+    async def move_absolute(self, axis, position, wait_until_idle=True):
+        self.check_motion_enabled()
+        await self.execute(PRIORITY_MOTION, "move abs",
+                           lambda: axis.move_absolute(position, wait_until_idle=False), is_motion=True)
+        self.motion_started()
+        if wait_until_idle:
+            await self.wait_until_idle(axis)
+
+    async def home(self, axis, wait_until_idle=True):
+        self.check_motion_enabled()
+        await self.execute(PRIORITY_MOTION, "home", lambda: axis.home(wait_until_idle=False), is_motion=True)
+        self.motion_started()
+        if wait_until_idle:
+            await self.wait_until_idle(axis)
+
+    def motion_started(self):
+        if self.on_motion is not None:
+            self.on_motion()
+
+    def fail_queued_motion(self):
+        '''
+        fail_queued_motion(): Fail every move and home still waiting in the queue with
+                              MotionStopped. Runs on the loop thread.
+        '''
+        kept = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item[6] and not item[4].done():
+                item[4].set_exception(MotionStopped("Motion was stopped before this %s was sent" % item[2]))
+            else:
+                kept.append(item)
+        for item in kept:
+            self.queue.put_nowait(item)
+
+    async def stop_all(self):
+        self.motion_enabled = False
+        self.fail_queued_motion()
+        return await self.execute(PRIORITY_STOP, "stop", lambda: self.connection.stop_all(wait_until_idle=False))
+
+    # Blocking proxies for threaded callers
+    def axis(self, axis):
+        return ScheduledAxis(self, axis)
+
+    def device_io(self, device):
+        return ScheduledDeviceIO(self, device)
+
+    def connection_proxy(self, priority=PRIORITY_DISPLAY):
+        return ScheduledConnection(self, priority)
+
+    def stats(self):
+        with self.stats_lock:
+            return {"queue_depth": self.queue.qsize() if self.ready.is_set() else 0,
+                    "queue_depth_max": self.queue_depth_max,
+                    "bus_occupancy": self.busy_s / (time.perf_counter() - self.started_at),
+                    "latency": dict((name, histogram.as_dict()) for name, histogram in self.latency.items())}
+
+
+class ScheduledAxis:
+    '''
+    ScheduledAxis: Drop-in for a zaber_motion Axis whose commands go through the scheduler.
+    '''
+    def __init__(self, scheduler, axis):
+        self.scheduler = scheduler
+        self.axis = axis
+
+    def move_absolute(self, position, wait_until_idle=True):
+        return self.scheduler.run(self.scheduler.move_absolute(self.axis, position, wait_until_idle))
+
+    def home(self, wait_until_idle=True):
+        return self.scheduler.run(self.scheduler.home(self.axis, wait_until_idle))
+
+    def wait_until_idle(self):
+        return self.scheduler.run(self.scheduler.wait_until_idle(self.axis))
+
+    def get_position(self):
+        return self.scheduler.run(self.scheduler.get_position(self.axis))
+
+    def is_busy(self):
+        return self.scheduler.submit(PRIORITY_STATUS, "get busy", self.axis.is_busy)
+
+    def is_homed(self):
+        return self.scheduler.submit(PRIORITY_STATUS, "get homed", self.axis.is_homed)
+
+    def stop(self):
+        return self.scheduler.submit(PRIORITY_STOP, "stop", lambda: self.axis.stop(wait_until_idle=False))
+
+
+class ScheduledDeviceIO:
+    '''
+    ScheduledDeviceIO: Drop-in for a DeviceIO. I/O is safety critical, so it runs at
+                       PRIORITY_SAFETY_IO.
+    '''
+    def __init__(self, scheduler, device):
+        self.scheduler = scheduler
+        self.device = device
+
+    def set_digital_output(self, channel, value):
+        return self.scheduler.run(self.scheduler.set_digital_output(self.device, channel, value))
+
+    def set_all_digital_outputs(self, values):
+        return self.scheduler.submit(PRIORITY_SAFETY_IO, "io set do",
+                                     lambda: self.device.io.set_all_digital_outputs(values))
+
+    def get_all_digital_inputs(self):
+        return self.scheduler.run(self.scheduler.get_digital_inputs(self.device))
+
+    def get_all_digital_outputs(self):
+        return self.scheduler.run(self.scheduler.get_digital_outputs(self.device))
+
+
+class ScheduledConnection:
+    '''
+    ScheduledConnection: Drop-in for the Connection's generic broadcast command, used by
+                         the BatchedPoller. Runs at the priority it was created with.
+    '''
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def generic_command_multi_response(self, command):
+        return self.scheduler.submit(self.priority, command,
+                                     lambda: self.scheduler.connection.generic_command_multi_response(command))
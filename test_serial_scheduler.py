@@ -0,0 +1,88 @@
+import threading
+import time
+
+import serial_scheduler
+
+
+class FakeAxis:
+    def __init__(self, log):
+        self.log = log
+        self.busy = False
+
+    def move_absolute(self, position, wait_until_idle=True):
+        self.log.append("move %d" % position)
+        self.busy = True
+
+    def is_busy(self):
+        return self.busy
+
+
+class FakeConnection:
+    '''
+    FakeConnection: Records what reaches the port. A generic command holds the port until
+                    release is set, like a slow reply.
+    '''
+    def __init__(self):
+        self.log = []
+        self.holding = threading.Event()
+        self.release = threading.Event()
+
+    def stop_all(self, wait_until_idle=True):
+        self.log.append("stop")
+
+    def generic_command_multi_response(self, command):
+        self.holding.set()
+        self.release.wait(5.0)
+        return []
+
+
+def wait_until(condition, timeout_s=2.0):
+    deadline = time.monotonic() + timeout_s
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_stop_overtakes_and_cancels_a_queued_move():
+    connection = FakeConnection()
+    scheduler = serial_scheduler.PortScheduler(connection).start()
+    axis = FakeAxis(connection.log)
+    errors = []
+
+    def move():
+        try:
+            scheduler.axis(axis).move_absolute(400000, wait_until_idle=False)
+        except Exception as error:
+            errors.append(error)
+
+    try:
+        # A slow command holds the port and a move queues up behind it
+        slow = threading.Thread(None, scheduler.connection_proxy().generic_command_multi_response, args=("slow",))
+        slow.start()
+        connection.holding.wait(2.0)
+        mover = threading.Thread(None, move)
+        mover.start()
+        wait_until(lambda: scheduler.queue.qsize() == 1)
+
+        stopper = threading.Thread(None, scheduler.run, args=(scheduler.stop_all(),))
+        stopper.start()
+        mover.join(2.0)
+        connection.release.set()
+        stopper.join(2.0)
+        slow.join(2.0)
+
+        assert connection.log == ["stop"]
+        assert not axis.busy
+        assert len(errors) == 1 and isinstance(errors[0], serial_scheduler.MotionStopped)
+        # Nothing moves until motion is re-enabled
+        try:
+            scheduler.axis(axis).move_absolute(1, wait_until_idle=False)
+            assert False, "move was sent while motion is stopped"
+        except serial_scheduler.MotionStopped:
+            pass
+        scheduler.enable_motion()
+        scheduler.axis(axis).move_absolute(2, wait_until_idle=False)
+        assert connection.log == ["stop", "move 2"]
+    finally:
+        connection.release.set()
+        scheduler.stop()
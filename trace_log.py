@@ -0,0 +1,105 @@
+import contextlib
+import json
+import os
+import queue
+import threading
+import time
+
+DEFAULT_TRACE_FILE = 'transfer_trace.jsonl'
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+
+
+class TraceLog:
+    '''
+    TraceLog: Append-only JSON-lines trace of transfer cycles, serial commands and poll
+              ticks. One record per line:
+                  {"t": <unix time>, "kind": "phase", "name": "scan", "duration_s": 9.8, ...}
+
+    Records are handed to a queue and written by a background writer thread, so the
+    poller and the serial scheduler never wait on the disk. The file rotates at
+    max_bytes, keeping backup_count old files (transfer_trace.jsonl.1, .2, ...). Nothing
+    is registered with the logging module, so a closed TraceLog leaves nothing behind.
+    '''
+    def __init__(self, path=DEFAULT_TRACE_FILE, max_bytes=DEFAULT_MAX_BYTES,
+                 backup_count=DEFAULT_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.trace_file = open(path, 'a')
+        self.record_queue = queue.Queue()
+        self.closed = False
+        self.writer_thread = threading.Thread(None, self.write_records, daemon=True)
+        self.writer_thread.start()
+
+    def write(self, kind, **fields):
+        if self.closed:
+            return
+        record = {"t": time.time(), "kind": kind}
+        record.update(fields)
+        self.record_queue.put(json.dumps(record) + '\n')
+
+    def write_records(self):
+        '''
+        write_records(): Writer thread. Writes whatever is queued, flushes once per batch
+                         and stops at the None that close() queues.
+        '''
+        while True:
+            lines = [self.record_queue.get()]
+            while True:
+                try:
+                    lines.append(self.record_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for line in lines:
+                if line is None:
+                    self.trace_file.flush()
+                    return
+                if self.max_bytes > 0 and self.trace_file.tell() + len(line) > self.max_bytes:
+                    self.rotate()
+                self.trace_file.write(line)
+            self.trace_file.flush()
+
+    def rotate(self):
+        '''
+        rotate(): Shift path.1 .. path.<backup_count - 1> up by one, move the current file
+                  to path.1 and start a new one.
+        '''
+        self.trace_file.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                older = "%s.%d" % (self.path, index)
+                if os.path.exists(older):
+                    os.replace(older, "%s.%d" % (self.path, index + 1))
+            os.replace(self.path, self.path + '.1')
+            self.trace_file = open(self.path, 'a')
+        else:
+            self.trace_file = open(self.path, 'w')
+
+    @contextlib.contextmanager
+    def span(self, kind, name, time_scale=1.0, **fields):
+        '''
+        span(): Time the enclosed block and write one record with its duration in seconds
+                (simulated seconds when time_scale is not 1). A block that raises is
+                recorded with its error.
+        '''
+        start = time.monotonic()
+        try:
+            yield fields
+        except BaseException as error:
+            fields["error"] = type(error).__name__
+            raise
+        finally:
+            self.write(kind, name=name, duration_s=(time.monotonic() - start) * time_scale, **fields)
+
+    def close(self):
+        '''
+        close(): Write out everything already queued and close the file. Records written
+                 afterwards are dropped.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.record_queue.put(None)
+        self.writer_thread.join()
+        self.trace_file.close()
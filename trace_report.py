@@ -0,0 +1,110 @@
+'''
+trace_report.py: Summarises a transfer trace log (see trace_log.py) into percentiles per
+                 cycle phase, per serial command and for the poll loop jitter, and names
+                 the leg of the cycle that costs the most time.
+
+    python trace_report.py [transfer_trace.jsonl]
+'''
+import json
+import os
+import sys
+
+import trace_log
+
+PERCENTILES = (50, 90, 99)
+
+
+def trace_files(path):
+    '''
+    trace_files(): The rotated backups (oldest first) followed by the live file.
+    '''
+    backups = []
+    index = 1
+    while os.path.exists("%s.%d" % (path, index)):
+        backups.append("%s.%d" % (path, index))
+        index += 1
+    files = list(reversed(backups))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_records(path):
+    for file_name in trace_files(path):
+        with open(file_name, 'r') as trace_file:
+            for line in trace_file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def percentile(sorted_values, percent):
+    index = int(round(percent / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarise(values):
+    values = sorted(values)
+    summary = {"count": len(values),
+               "mean": sum(values) / len(values),
+               "max": values[-1]}
+    for percent in PERCENTILES:
+        summary["p%d" % percent] = percentile(values, percent)
+    return summary
+
+
+def collect(records):
+    '''
+    collect(): Group the values we report on: {section: {name: [values]}}.
+    '''
+    groups = {"phase": {}, "command": {}, "poll": {}, "cycle": {}}
+    for record in records:
+        kind = record.get("kind")
+        if kind == "phase" and "error" not in record:
+            groups["phase"].setdefault(record["name"], []).append(record["duration_s"])
+        elif kind == "command":
+            groups["command"].setdefault(record["name"] + " latency", []).append(record["latency_ms"])
+            groups["command"].setdefault(record["name"] + " queued", []).append(record["queued_ms"])
+        elif kind == "poll_tick":
+            groups["poll"].setdefault("interval", []).append(record["interval_ms"])
+            groups["poll"].setdefault("jitter", []).append(record["jitter_ms"])
+            groups["poll"].setdefault("duration", []).append(record["duration_ms"])
+        elif kind == "cycle":
+            groups["cycle"].setdefault("cycle", []).append(record["duration_s"])
+    return groups
+
+
+def print_table(title, unit, group):
+    if not group:
+        return
+    print("%s (%s)" % (title, unit))
+    print("  %-24s %7s %9s %9s %9s %9s %9s" % ("", "count", "p50", "p90", "p99", "max", "mean"))
+    for name in sorted(group):
+        summary = summarise(group[name])
+        print("  %-24s %7d %9.2f %9.2f %9.2f %9.2f %9.2f" %
+              (name, summary["count"], summary["p50"], summary["p90"], summary["p99"],
+               summary["max"], summary["mean"]))
+    print("")
+
+
+def report(path=trace_log.DEFAULT_TRACE_FILE):
+    groups = collect(read_records(path))
+    if not any(groups.values()):
+        print("no trace records in %s" % path)
+        return groups
+    print_table("Cycles", "s", groups["cycle"])
+    print_table("Cycle phases", "s", groups["phase"])
+    print_table("Serial commands", "ms", groups["command"])
+    print_table("Poll loop", "ms", groups["poll"])
+
+    # Waiting for the Robomet isn't something we can speed up, so leave it out
+    legs = dict((name, sum(values) / len(values)) for name, values in groups["phase"].items()
+                if name != "wait_for_request")
+    if legs:
+        slowest = max(legs, key=legs.get)
+        print("slowest leg: %s (mean %.2f s)" % (slowest, legs[slowest]))
+    return groups
+
+
+if __name__ == '__main__':
+    report(sys.argv[1] if len(sys.argv) > 1 else trace_log.DEFAULT_TRACE_FILE)
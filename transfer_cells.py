@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+
+import poll_rate
+import port_discovery
+import trace_log
+import transfer_core
+
+CELLS_FILE = 'transfer_cells.json'
+DEFAULT_CELL = 'default'
+# trace_file default of add_cell(); an explicit None turns tracing off
+DEFAULT_TRACE = object()
+
+
+def cell_files(name):
+    '''
+    cell_files(): Positions and trace file for a cell. The default cell keeps the
+                  original single-cell file names.
+    '''
+    if name == DEFAULT_CELL:
+        return transfer_core.POSITIONS_FILE, trace_log.DEFAULT_TRACE_FILE
+    return 'transfer_positions.%s.json' % name, 'transfer_trace.%s.jsonl' % name
+
+
+class CellManager:
+    '''
+    CellManager: The transfer cells run by one daemon, by name.
+
+    Each cell is its own TransferController with its own port, device addresses,
+    positions file, serial scheduler, poller and auto mode worker, so a cell that fails
+    to connect or faults mid-cycle leaves the others running. The manager only adds the
+    name lookup, bulk connect and the aggregate status.
+
+    transfer_cells.json lists the cells:
+        [{"name": "cell1", "port": "COM3"},
+         {"name": "cell2", "port": "COM4", "devices": {"xy": 1, "z": 2}}]
+    "port" is connected at startup by connect_all(); without one, a cell reconnects on
+    the port it last connected on. "positions_file", "trace_file" (null for no trace),
+    "fast_poll_ms", "slow_poll_ms" and "homing_stages" (e.g. [["z"], ["x", "y"]]) are
+    optional.
+    '''
+    def __init__(self, cell_configs=None, discovery=None):
+        self.port_discovery = discovery or port_discovery.PortDiscovery()
+        self.cells = {}
+        self.ports = {}
+        self.cells_lock = threading.Lock()
+        # callback -> {cell name: listener registered on that cell}
+        self.listeners = {}
+        # callbacks that follow every cell, including cells added later
+        self.all_cell_listeners = set()
+        for config in cell_configs or [{"name": DEFAULT_CELL}]:
+            self.add_cell(**config)
+
+    @classmethod
+    def from_json_file(cls, path=CELLS_FILE):
+        '''
+        from_json_file(): The cells listed in path, or just the default cell if there is
+                          no such file.
+        '''
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as json_file:
+            return cls(json.load(json_file))
+
+    def add_cell(self, name, port=None, devices=None, positions_file=None, trace_file=DEFAULT_TRACE,
+                 fast_poll_ms=poll_rate.FAST_POLL_MS, slow_poll_ms=poll_rate.SLOW_POLL_MS,
+                 homing_stages=None):
+        default_positions_file, default_trace_file = cell_files(name)
+        with self.cells_lock:
+            if name in self.cells:
+                raise KeyError("Cell %s already exists" % name)
+            controller = transfer_core.TransferController(positions_file or default_positions_file,
+                                                          fast_poll_ms, slow_poll_ms,
+                                                          default_trace_file if trace_file is DEFAULT_TRACE else trace_file,
+                                                          name=name, devices=devices,
+                                                          port_discovery=self.port_discovery,
+                                                          homing_stages=homing_stages)
+            self.cells[name] = controller
+            self.ports[name] = port
+            for callback in self.all_cell_listeners:
+                self.listen_to_cell(callback, controller)
+        return self.names()
+
+    def set_port(self, name, port):
+        '''
+        set_port(): Configure the port a cell connects on, e.g. from --com. Takes effect
+                    on the next connect_all().
+        '''
+        controller = self.cell(name)
+        with self.cells_lock:
+            self.ports[controller.name] = port
+
+    def remove_cell(self, name):
+        with self.cells_lock:
+            controller = self.cells.pop(name)
+            self.ports.pop(name)
+            for cell_listeners in self.listeners.values():
+                if name in cell_listeners:
+                    controller.remove_listener(cell_listeners.pop(name))
+        controller.close()
+        return self.names()
+
+    def names(self):
+        with self.cells_lock:
+            return sorted(self.cells)
+
+    def cell(self, name=None):
+        '''
+        cell(): The named cell. With no name, the default cell, or the only cell if
+                there is just one.
+        '''
+        with self.cells_lock:
+            if name is None:
+                if DEFAULT_CELL in self.cells or len(self.cells) != 1:
+                    name = DEFAULT_CELL
+                else:
+                    name = next(iter(self.cells))
+            if name not in self.cells:
+                raise KeyError("No cell named %s" % name)
+            return self.cells[name]
+
+    def listen_to_cell(self, callback, controller):
+        cell_listener = lambda event, data: callback(controller.name, event, data)
+        self.listeners[callback][controller.name] = cell_listener
+        controller.add_listener(cell_listener)
+
+    def add_listener(self, callback, name=None):
+        '''
+        add_listener(): Follow the events of one cell, or of every cell (now and added
+                        later) when name is None, as callback(cell, event, data).
+        '''
+        controller = self.cell(name) if name is not None else None
+        with self.cells_lock:
+            self.listeners[callback] = {}
+            if controller is not None:
+                self.listen_to_cell(callback, controller)
+                return
+            self.all_cell_listeners.add(callback)
+            for controller in self.cells.values():
+                self.listen_to_cell(callback, controller)
+
+    def remove_listener(self, callback):
+        with self.cells_lock:
+            self.all_cell_listeners.discard(callback)
+            for name, cell_listener in self.listeners.pop(callback, {}).items():
+                self.cells[name].remove_listener(cell_listener)
+
+    def in_use_ports(self):
+        with self.cells_lock:
+            return [controller.current_comport for controller in self.cells.values()
+                    if controller.SYSTEM_STATE == 'ONLINE']
+
+    def connect_all(self):
+        '''
+        connect_all(): Connect every offline cell that has a port configured or a last good
+                       port cached, side by side. A cell that fails to connect is reported
+                       and left offline.
+        '''
+        with self.cells_lock:
+            pending = [(self.cells[name], port or self.port_discovery.last_good_port(name))
+                       for name, port in self.ports.items() if self.cells[name].SYSTEM_STATE != 'ONLINE']
+        pending = [(controller, port) for controller, port in pending if port is not None]
+        errors = {}
+
+        def connect_cell(controller, port):
+            try:
+                controller.connect(port)
+            except Exception as error:
+                errors[controller.name] = "%s: %s" % (type(error).__name__, error)
+                controller.set_message("Connection to %s failed" % port)
+
+        threads = [threading.Thread(None, connect_cell, args=(controller, port), daemon=True)
+                   for controller, port in pending]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name in errors:
+            print("cell %s: %s" % (name, errors[name]))
+        return errors
+
+    def auto_connect(self):
+        '''
+        auto_connect(): Startup. Reconnect cells on their configured or cached ports right
+                        away, then probe the serial ports in the background.
+        '''
+        errors = self.connect_all()
+        self.discover_ports()
+        return errors
+
+    def discover_ports(self):
+        '''
+        discover_ports(): Start a background probe of the free serial ports. Returns the
+                          cached results; every cell publishes a "ports" event with the
+                          fresh ones when the probe finishes.
+        '''
+        self.port_discovery.discover_in_background(self.discovery_finished, self.in_use_ports())
+        return self.port_discovery.port_results()
+
+    def discovery_finished(self, results):
+        # With exactly one cell still waiting for a port and exactly one free port that has
+        # the controllers on it, the match is unambiguous; anything else is left to the operator.
+        with self.cells_lock:
+            waiting = [controller for name, controller in self.cells.items()
+                       if controller.SYSTEM_STATE != 'ONLINE' and self.ports[name] is None]
+            cells = list(self.cells.values())
+        free_ports = [port for port in sorted(results) if results[port]["zaber"] and port not in self.in_use_ports()]
+        if len(waiting) == 1 and len(free_ports) == 1:
+            try:
+                waiting[0].connect(free_ports[0])
+            except Exception as error:
+                print("cell %s: auto-connect to %s failed: %s" % (waiting[0].name, free_ports[0], error))
+        for controller in cells:
+            controller.publish("ports", results)
+
+    def status(self):
+        '''
+        status(): Aggregate status: a short summary of every cell plus totals. A cell whose
+                  status cannot be read is reported with its error instead.
+        '''
+        with self.cells_lock:
+            cells = list(self.cells.values())
+        summary = {}
+        for controller in cells:
+            try:
+                cell_status = controller.status()
+            except Exception as error:
+                summary[controller.name] = {"error": "%s: %s" % (type(error).__name__, error)}
+                continue
+            summary[controller.name] = dict((key, cell_status[key]) for key in
+                                            ("system_state", "comport", "message", "auto_mode",
+                                             "transfer_state", "recipe", "cycles_completed"))
+        return {"cells": summary,
+                "online": sum(1 for cell in summary.values() if cell.get("system_state") == 'ONLINE'),
+                "auto_mode": sum(1 for cell in summary.values() if cell.get("auto_mode")),
+                "faulted": sorted(name for name, cell in summary.items() if "error" in cell),
+                "cycles_completed": sum(cell.get("cycles_completed", 0) for cell in summary.values())}
+
+    def close(self):
+        for name in self.names():
+            self.cells[name].close()
@@ -0,0 +1,530 @@
+import threading
+import time
+
+import axis_poller
+import motion_planner
+import output_driver
+import poll_rate
+import port_discovery
+import position_index
+import position_store
+import serial_scheduler
+import trace_log
+import transfer_state_machine
+import units
+import zaber_simulator
+
+POSITIONS_FILE = 'transfer_positions.json'
+# Zaber device address of each controller in a cell
+DEFAULT_DEVICES = {"xy": 1, "z": 2}
+
+
+class TransferController:
+    '''
+    TransferController: Qt-free core of one transfer cell.
+
+    Owns the cell's Zaber Connection, the poller, the output driver, the motion planner and the
+    auto mode state machine. Anything that wants to follow along (the IPC server, the GUI)
+    registers a listener and receives ("snapshot", dict) and ("status_message", str) events.
+
+    zaber_motion and pyserial are only imported when they are first needed so the core
+    starts without paying for them.
+    '''
+    def __init__(self, positions_file=POSITIONS_FILE, fast_poll_ms=poll_rate.FAST_POLL_MS,
+                 slow_poll_ms=poll_rate.SLOW_POLL_MS, trace_file=trace_log.DEFAULT_TRACE_FILE,
+                 name='default', devices=None, port_discovery=None, homing_stages=None):
+        self.name = name
+        # Shared PortDiscovery; told about every successful connect so the daemon can
+        # reconnect on the same port next time
+        self.port_discovery = port_discovery
+        self.devices = dict(DEFAULT_DEVICES, **(devices or {}))
+        self.positions_file = positions_file
+        # Poll period bounds; see poll_rate.AdaptivePollRate
+        self.fast_poll_ms = fast_poll_ms
+        self.slow_poll_ms = slow_poll_ms
+        self.poll_rate = None
+        # Set to cut the current poll wait short, e.g. when a move starts
+        self.poll_wake = threading.Event()
+        # Cycle phases, serial commands and poll ticks go to a rotating JSON-lines file;
+        # summarise it with trace_report.py. None turns tracing off.
+        self.trace = trace_log.TraceLog(trace_file) if trace_file is not None else None
+        self.SYSTEM_STATE = 'OFFLINE'
+        # Held for the whole of connect() / disconnect(), so two connects (e.g. the operator
+        # and a background auto-connect) can't both get past the ONLINE check
+        self.connection_lock = threading.RLock()
+        self.current_comport = ''
+        self.system_message = "Not Connected"
+        self.listeners = []
+        self.listeners_lock = threading.Lock()
+
+        self.positions = position_store.empty_stations()
+        # Per-axis (x, y, z) window in counts for the "am I at station X" checks
+        self.position_tolerance_steps = position_index.DEFAULT_TOLERANCE_STEPS
+        self.position_index = position_index.PositionIndex(self.positions, self.position_tolerance_steps)
+        # Counts <-> mm calibration, read from the devices at connect
+        self.units = None
+        # Homing order as groups of axes homed together, e.g. [['z'], ['x', 'y']].
+        # None lets the planner decide from whether Z is homed and at the safe height.
+        self.homing_stages = None
+        self.set_homing_stages(homing_stages)
+        self.time_to_ready = None
+
+        # Simulated seconds per wall-clock second; only differs from 1 on a simulated port
+        self.time_scale = 1.0
+        self.snapshot = None
+        self.system_at_home = False
+        self.system_at_r3d_load = False
+        self.is_at_xz_load = False
+        self.is_at_sras_load = False
+        self.is_in_automode = False
+        self.transfer_machine = None
+        # Worker threads that move the stages; enable_motion() waits for them to finish
+        self.auto_daemon_thread = None
+        self.homing_thread = None
+
+        # Taught stations, read once here. Saves and recipe switches come back through
+        # positions_changed, which is how the matcher and the motion code pick them up.
+        self.position_store = position_store.PositionStore(self.positions_file)
+        self.position_store.add_listener(self.positions_changed)
+        self.positions_file_found = self.position_store.load()
+
+    def add_listener(self, callback):
+        with self.listeners_lock:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.listeners_lock:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+    def publish(self, event, data):
+        with self.listeners_lock:
+            listeners = list(self.listeners)
+        for callback in listeners:
+            callback(event, data)
+
+    def set_message(self, message):
+        self.system_message = message
+        self.publish("status_message", message)
+
+    def list_ports(self):
+        '''
+        list_ports(): Every serial port on this machine, as "<device> - <description>".
+                      Ports the last discovery found the transfer controllers on come first.
+        '''
+        import serial.tools.list_ports
+        zaber_ports = self.port_discovery.zaber_ports() if self.port_discovery is not None else []
+        ports = [current_port.__str__() for current_port in serial.tools.list_ports.comports()]
+        ports.sort(key=lambda port: port.split(' ')[0] not in zaber_ports)
+        return ports + [zaber_simulator.SIM_PORT_PREFIX + " - Simulated transfer cell"]
+
+    def open_connection(self, port):
+        '''
+        open_connection(): Open port with zaber_motion, or with the simulator for "SIM..."
+                           ports (which also get scripted Robomet and SRAS peers).
+        '''
+        if zaber_simulator.is_simulated_port(port):
+            connection = zaber_simulator.SimulatedConnection.open_serial_port(port)
+            connection.add_peer(zaber_simulator.RobometPeer(connection))
+            connection.add_peer(zaber_simulator.SrasPeer(connection, self.positions["sras_load"]))
+            return connection
+        from zaber_motion.ascii import Connection
+        return Connection.open_serial_port(port)
+
+    def connect(self, port):
+        '''
+        connect(): Open the Zaber connection on port, start polling and homing.
+        '''
+        with self.connection_lock:
+            if self.SYSTEM_STATE == 'ONLINE':
+                raise RuntimeError("Already connected to " + self.current_comport)
+            self.current_comport = port
+            self.zaber_ascii_connection = self.open_connection(self.current_comport)
+            self.serial_scheduler = None
+            self.encoder_thread = None
+            self.homing_thread = None
+            try:
+                self.check_controllers()
+                self.start_cell()
+            except BaseException:
+                # Keep nothing of a half-made connection: stop what was started, close the port
+                self.close_cell()
+                raise
+            # A simulator session should not make the next startup skip the real hardware
+            if self.port_discovery is not None and not zaber_simulator.is_simulated_port(port):
+                self.port_discovery.remember(self.name, port)
+            self.publish_connection()
+        return self.status()
+
+    def publish_connection(self):
+        # Lets clients follow connects they did not ask for, e.g. the startup auto-connect
+        self.publish("connection", {"system_state": self.SYSTEM_STATE, "comport": self.current_comport})
+
+    def check_controllers(self):
+        '''
+        check_controllers(): One round trip before the cell goes ONLINE: both of its
+                             controllers have to answer on the port, e.g. a cached last good
+                             port may have another device on it by now.
+        '''
+        expected_axes = {self.devices["xy"]: 2, self.devices["z"]: 1}
+        axis_counts = port_discovery.read_axis_counts(self.zaber_ascii_connection)
+        if any(axis_counts.get(address, 0) < axes for address, axes in expected_axes.items()):
+            raise RuntimeError("Transfer controllers not found on %s: expected devices %s, found %s" %
+                               (self.current_comport, expected_axes, axis_counts))
+
+    def start_cell(self):
+        '''
+        start_cell(): Everything connect() sets up on an open, checked port: the scheduler,
+                      axes, poller and output driver, then polling and homing.
+        '''
+        self.time_scale = getattr(self.zaber_ascii_connection, 'time_scale', 1.0)
+        self.xy_controller = self.zaber_ascii_connection.get_device(self.devices["xy"])
+        self.z_controller = self.zaber_ascii_connection.get_device(self.devices["z"])
+        self.units = self.read_unit_calibration()
+        # Everything below talks to the port through the scheduler's single command queue
+        self.serial_scheduler = serial_scheduler.PortScheduler(self.zaber_ascii_connection,
+                                                              self.time_scale, self.trace).start()
+        self.x_axis = self.serial_scheduler.axis(self.xy_controller.get_axis(1))
+        self.y_axis = self.serial_scheduler.axis(self.xy_controller.get_axis(2))
+        self.z_axis = self.serial_scheduler.axis(self.z_controller.get_axis(1))
+        self.motion_planner = motion_planner.MotionPlanner(self.x_axis, self.y_axis, self.z_axis,
+                                                           lambda: self.positions)
+        self.axis_poller = axis_poller.BatchedPoller(self.serial_scheduler.connection_proxy(),
+                                                     {'x': (self.devices["xy"], 1),
+                                                      'y': (self.devices["xy"], 2),
+                                                      'z': (self.devices["z"], 1)},
+                                                     self.devices["xy"], self.devices["z"], units=self.units)
+        self.xy_outputs = output_driver.DigitalOutputDriver(self.serial_scheduler.device_io(self.xy_controller))
+        self.poll_rate = poll_rate.AdaptivePollRate(self.fast_poll_ms, self.slow_poll_ms,
+                                                    time_scale=self.time_scale)
+        self.serial_scheduler.on_motion = self.poll_wake.set
+        self.SYSTEM_STATE = 'ONLINE'
+        self.set_message("Connected. Not Homed.")
+
+        self.encoder_thread = threading.Thread(target=self.start_polling_axes, daemon=True)
+        self.encoder_thread.start()
+        self.xy_outputs.set_all_digital_outputs([False, False, False, False])
+        self.homing_thread = threading.Thread(None, self.home_connected_stages, daemon=True)
+        self.homing_thread.start()
+        self.xy_outputs.set_digital_output(transfer_state_machine.SRAS_READY_OUTPUT, True)
+
+    def close_cell(self):
+        '''
+        close_cell(): Stop polling, the scheduler and homing and close the port. Also undoes
+                      a connect() that failed part way.
+        '''
+        self.SYSTEM_STATE = 'OFFLINE'
+        self.poll_wake.set()
+        if self.encoder_thread is not None:
+            self.encoder_thread.join(timeout=2.0)
+        # Stops the stages and fails whatever homing or manual move is still waiting
+        if self.serial_scheduler is not None:
+            self.serial_scheduler.stop()
+        if self.homing_thread is not None:
+            self.homing_thread.join(timeout=2.0)
+        self.zaber_ascii_connection.close()
+
+    def read_unit_calibration(self):
+        '''
+        read_unit_calibration(): Counts per mm of every axis, read once per connection.
+                                 Without it the cell still runs, in counts only.
+        '''
+        axes = {'x': self.xy_controller.get_axis(1),
+                'y': self.xy_controller.get_axis(2),
+                'z': self.z_controller.get_axis(1)}
+        try:
+            if zaber_simulator.is_simulated_port(self.current_comport):
+                millimetres = zaber_simulator.MILLIMETRES
+            else:
+                from zaber_motion import Units
+                millimetres = Units.LENGTH_MILLIMETRES
+                # Unit conversion needs to know what stage is attached to each controller
+                self.xy_controller.identify()
+                self.z_controller.identify()
+            return units.AxisUnits.from_axes(axes, millimetres)
+        except Exception as error:
+            print("no unit calibration, positions in counts only: %s" % error)
+            return None
+
+    def require_units(self, unit):
+        '''
+        require_units(): The calibration, when unit needs one.
+        '''
+        if units.check_unit(unit) == units.MM and self.units is None:
+            raise RuntimeError("No mm calibration; connect to the controllers first")
+        return self.units
+
+    def disconnect(self):
+        if self.is_in_automode:
+            self.set_auto_mode(False)
+        with self.connection_lock:
+            if self.SYSTEM_STATE == 'ONLINE':
+                self.close_cell()
+            self.set_message("Not Connected")
+            self.publish_connection()
+        return self.status()
+
+    def close(self):
+        '''
+        close(): Disconnect and flush the trace log. Call once when the daemon exits.
+        '''
+        self.disconnect()
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def stop_motion(self):
+        '''
+        stop_motion(): Leave auto mode and stop every axis. The stop jumps ahead of
+                       everything else waiting for the port, and no thread that was
+                       waiting on a move (auto mode, homing, a manual move) sends its next
+                       step: the planner is aborted and the scheduler refuses motion until
+                       auto mode or a manual move is started again.
+        '''
+        if self.is_in_automode:
+            self.set_auto_mode(False)
+        if self.SYSTEM_STATE == 'ONLINE':
+            self.motion_planner.abort()
+            self.serial_scheduler.run(self.serial_scheduler.stop_all())
+        self.set_message("Stopped.")
+        return self.status()
+
+    def enable_motion(self):
+        '''
+        enable_motion(): Re-arm motion after stop_motion(). Only called when the operator
+                         explicitly starts something that moves. The planner is shared, so
+                         an auto mode worker that was switched off, or a homing run that
+                         was stopped, is waited for first; re-arming would otherwise let it
+                         carry on with its next step. Its move under way finishes; nothing
+                         after that is sent.
+        '''
+        threads = [self.auto_daemon_thread]
+        if self.motion_planner.aborted.is_set():
+            threads.append(self.homing_thread)
+        for thread in threads:
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        self.motion_planner.resume()
+        self.serial_scheduler.enable_motion()
+
+    def set_homing_stages(self, stages):
+        '''
+        set_homing_stages(): Homing order used from the next connect. None restores the
+                             planner's default.
+        '''
+        self.homing_stages = motion_planner.check_homing_stages(stages) if stages is not None else None
+        return self.homing_stages
+
+    def home_connected_stages(self):
+        # Axes in the same stage home together; Z goes first on its own when it
+        # isn't already at the safe height.
+        try:
+            self.time_to_ready = self.motion_planner.home_all(
+                self.homing_stages,
+                on_stage=lambda stage: self.set_message("Homing " + "/".join(stage).upper() + "..."))
+        except (motion_planner.MotionAborted, serial_scheduler.MotionStopped):
+            self.set_message("Homing stopped. Not Homed.")
+            return
+        except Exception as error:
+            print("homing failed: %s: %s" % (type(error).__name__, error))
+            self.set_message("Homing failed: %s. Not Homed." % error)
+            return
+        self.set_message("Homing Complete. Ready in %.1f s." % self.time_to_ready)
+        return
+
+    def start_polling_axes(self):
+        '''
+        start_polling_axes(): Poll loop. The period adapts to what the cell is doing: fast
+                              while an axis is busy or auto mode waits on a handshake,
+                              a slow heartbeat when everything is parked.
+        '''
+        last_tick_start = None
+        delay_s = self.poll_rate.fast_s
+        while(self.SYSTEM_STATE == 'ONLINE'):
+            tick_start = time.monotonic()
+            self.poll_wake.clear()
+            # One batched read of every position and I/O line on the port
+            try:
+                self.snapshot = self.axis_poller.poll()
+            except Exception as error:
+                if self.SYSTEM_STATE != 'ONLINE':
+                    break
+                print("poll failed: %s" % error)
+                self.poll_wake.wait(self.poll_rate.slow_s)
+                continue
+            poll_duration_s = time.monotonic() - tick_start
+
+            # Named position checks
+            matched_stations = self.position_index.match_all(self.snapshot.x, self.snapshot.y, self.snapshot.z)
+            self.system_at_home = "home" in matched_stations
+            self.system_at_r3d_load = "robomet_load" in matched_stations
+            self.is_at_xz_load = "xz_transfer" in matched_stations
+            self.is_at_sras_load = "sras_load" in matched_stations
+
+            self.publish("snapshot", self.snapshot._asdict())
+
+            if self.is_in_automode:
+                self.update_r3d_load_output()
+
+            # Wake the auto mode state machine so it can react to this tick immediately
+            if self.transfer_machine is not None:
+                self.transfer_machine.notify(inputs=self.snapshot.xy_inputs,
+                                             sras_inputs=self.snapshot.z_inputs,
+                                             at_home=self.system_at_home,
+                                             at_r3d_load=self.system_at_r3d_load,
+                                             at_xz_load=self.is_at_xz_load,
+                                             at_sras_load=self.is_at_sras_load)
+            if self.trace is not None and last_tick_start is not None:
+                interval_ms = (tick_start - last_tick_start) * 1000
+                self.trace.write("poll_tick", interval_ms=interval_ms,
+                                 jitter_ms=interval_ms - delay_s * 1000,
+                                 duration_ms=(time.monotonic() - tick_start) * 1000,
+                                 mode="fast" if self.poll_rate.fast else "slow")
+            last_tick_start = tick_start
+            # In auto mode every state is waiting on some input from the Robomet or the SRAS
+            delay_s = self.poll_rate.next_delay_s(self.snapshot, self.is_in_automode, tick_start, poll_duration_s)
+            # Sleep out the remainder of the tick so the serial time counts towards the
+            # delay. A move starting wakes the loop early.
+            self.poll_wake.wait(max(0, delay_s - (time.monotonic() - tick_start)))
+        print("poller stopped. rate %(poll_rate_hz).1f Hz, latency %(latency)s" % self.axis_poller.stats())
+        return
+
+    def set_auto_mode(self, enabled):
+        if enabled and not self.is_in_automode:
+            if self.SYSTEM_STATE != 'ONLINE':
+                raise RuntimeError("Not connected")
+            self.enable_motion()
+            self.is_in_automode = True
+            self.set_message("Auto Mode")
+            machine = transfer_state_machine.TransferStateMachine(
+                self.x_axis, self.y_axis, self.z_axis, self.xy_outputs,
+                lambda: self.positions, planner=self.motion_planner,
+                time_scale=self.time_scale, trace=self.trace)
+            machine.on_state_change = lambda state, message: self.auto_mode_state_changed(machine, state, message)
+            machine.on_error = lambda error: self.auto_mode_failed(machine, error)
+            self.transfer_machine = machine
+            self.auto_daemon_thread = machine.start()
+        elif not enabled and self.is_in_automode:
+            self.is_in_automode = False
+            machine, self.transfer_machine = self.transfer_machine, None
+            if machine is not None:
+                machine.stop()
+            self.set_message("Auto Mode Disabled")
+            print("digital output writes: %(issued)d issued, %(suppressed)d suppressed" %
+                  self.xy_outputs.write_counts())
+        return self.is_in_automode
+
+    def auto_mode_state_changed(self, machine, state, message):
+        # Called on the state machine's thread. A machine that was switched off may still
+        # report on its way out; only the current one gets to set the message.
+        if machine is not self.transfer_machine:
+            return
+        if message is not None:
+            self.set_message(message)
+
+    def auto_mode_failed(self, machine, error):
+        # Called on the state machine's thread once it has given up; auto mode is off from
+        # here on, as if the operator had switched it off
+        if machine is not self.transfer_machine:
+            return
+        self.is_in_automode = False
+        self.transfer_machine = None
+
+    def update_r3d_load_output(self):
+        '''
+        update_r3d_load_output(): Drive bClearToLoadSRAS from the Robomet load position check.
+                                  Called once per poll tick; the output driver only writes
+                                  to the controller when the value actually flips.
+        '''
+        self.xy_outputs.set_digital_output(transfer_state_machine.CTL_OUTPUT,
+                                           self.system_at_r3d_load)
+
+    def positions_changed(self, recipe, stations):
+        '''
+        positions_changed(): PositionStore listener. The planner and the state machine read
+                             self.positions on every move, so swapping it in is enough for
+                             them; the matcher index is rebuilt for the next poll tick.
+        '''
+        self.position_index = position_index.PositionIndex(stations, self.position_tolerance_steps)
+        self.positions = stations
+        if self.SYSTEM_STATE == 'ONLINE':
+            for peer in getattr(self.zaber_ascii_connection, 'peers', []):
+                if isinstance(peer, zaber_simulator.SrasPeer):
+                    peer.sras_position = stations["sras_load"]
+        self.publish("positions", {"recipe": recipe, "stations": stations})
+
+    def get_positions(self, unit=units.COUNTS):
+        if self.require_units(unit) is None or unit == units.COUNTS:
+            return self.positions
+        return self.units.stations_from_counts(self.positions, unit)
+
+    def save_positions(self, positions, recipe=None, note=None, unit=units.COUNTS):
+        '''
+        save_positions(): Store newly taught positions as the next version of recipe (the
+                          active one by default). Positions in mm are stored as counts.
+        '''
+        if self.require_units(unit) is not None:
+            positions = self.units.stations_to_counts(positions, unit)
+        version = self.position_store.save(positions, recipe, note)
+        return {"recipe": recipe or self.position_store.active_recipe, "version": version}
+
+    def set_position_tolerance(self, tolerance, unit=units.COUNTS):
+        '''
+        set_position_tolerance(): Per-axis (x, y, z) window for the station checks. Needs
+                                  exactly three positive values, which must still be at
+                                  least one count each after conversion.
+        '''
+        tolerance = units.check_tolerance(tolerance)
+        if self.require_units(unit) is not None:
+            tolerance = self.units.tolerance_to_counts(tolerance, unit)
+        self.position_tolerance_steps = units.check_tolerance(tuple(int(round(value)) for value in tolerance))
+        self.position_index = position_index.PositionIndex(self.positions, self.position_tolerance_steps)
+        return self.position_tolerance_steps
+
+    def move_axis(self, axis_name, position, unit=units.COUNTS):
+        '''
+        move_axis(): Manual move of one axis to an absolute position. Not allowed in auto mode.
+                     Returns the commanded target in unit.
+        '''
+        if self.SYSTEM_STATE != 'ONLINE':
+            raise RuntimeError("Not connected")
+        if self.is_in_automode:
+            raise RuntimeError("Leave auto mode before moving axes by hand")
+        counts = int(round(position))
+        if self.require_units(unit) is not None:
+            counts = self.units.to_counts(axis_name, position, unit)
+        self.enable_motion()
+        self.motion_planner.move_axis(axis_name, counts)
+        if self.units is None:
+            return counts
+        # The target actually commanded (whole counts), in the unit it was asked for
+        return self.units.from_counts(axis_name, counts, unit)
+
+    def reload_positions(self):
+        '''
+        reload_positions(): Re-read the positions file, e.g. after editing it by hand.
+        '''
+        self.position_store.load()
+        return self.positions
+
+    def status(self):
+        return {"cell": self.name,
+                "system_state": self.SYSTEM_STATE,
+                "comport": self.current_comport,
+                "message": self.system_message,
+                "auto_mode": self.is_in_automode,
+                "transfer_state": self.transfer_machine.state if self.transfer_machine is not None else None,
+                "time_to_ready": self.time_to_ready,
+                "homing_stages": self.homing_stages,
+                "cycles_completed": len(self.transfer_machine.cycle_times) if self.transfer_machine is not None else 0,
+                "positions_file_found": self.positions_file_found,
+                "recipe": self.position_store.active_recipe,
+                "position_tolerance_steps": self.position_tolerance_steps,
+                "counts_per_mm": self.units.counts_per_mm if self.units is not None else None,
+                "at_home": self.system_at_home,
+                "at_r3d_load": self.system_at_r3d_load,
+                "at_xz_load": self.is_at_xz_load,
+                "at_sras_load": self.is_at_sras_load,
+                "snapshot": self.snapshot._asdict() if self.snapshot is not None else None,
+                "serial": self.serial_scheduler.stats() if self.SYSTEM_STATE == 'ONLINE' else None,
+                "polling": self.poll_rate.stats() if self.poll_rate is not None else None}
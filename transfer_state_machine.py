@@ -0,0 +1,354 @@
+import collections
+import contextlib
+import threading
+import time
+
+import motion_planner
+import serial_scheduler
+
+# Transfer states. A full Robomet -> SRAS -> Robomet cycle walks through these in order
+# and then drops back to IDLE to wait for the next request.
+IDLE = 'IDLE'
+LOAD = 'LOAD'
+HANDOFF = 'HANDOFF'
+SRAS = 'SRAS'
+SCAN = 'SCAN'
+RETURN = 'RETURN'
+PICKUP = 'PICKUP'
+TRANSFER_STATES = (IDLE, LOAD, HANDOFF, SRAS, SCAN, RETURN, PICKUP)
+
+# Digital input indices on the XY controller (0-based, as returned by get_all_digital_inputs)
+RTL_INPUT = 0           # bReadyToLoadSRAS
+RTS_INPUT = 1           # bReadyToSRAS
+R3D_SAFE_INPUT = 2      # R3DSafetyOK
+
+# Digital output channels on the XY controller (1-based, as used by set_digital_output)
+SRAS_READY_OUTPUT = 1   # bSRAS_Ready
+CTL_OUTPUT = 2          # bClearToLoadSRAS
+SRAS_COMPLETE_OUTPUT = 3
+SRAS_ERROR_OUTPUT = 4
+
+# Digital input indices on the Z controller, driven by the SRAS (0-based)
+SCAN_COMPLETE_INPUT = 0
+SCAN_ERROR_INPUT = 1
+
+# While the SRAS scans, Z is lowered to this many counts above the SRAS load height so the
+# pickup afterwards is only a short descent. None keeps Z fully retracted during the scan.
+DEFAULT_APPROACH_CLEARANCE_STEPS = 100000
+
+# Seconds allowed in each state before the cycle is abandoned. None waits forever.
+DEFAULT_STATE_TIMEOUTS = {IDLE: None,
+                          LOAD: 60.0,
+                          HANDOFF: 60.0,
+                          SRAS: 60.0,
+                          SCAN: 120.0,
+                          RETURN: 60.0,
+                          PICKUP: 300.0}
+
+
+class TransferTimeout(Exception):
+    '''
+    TransferTimeout: Raised when the state machine sits in one state for longer than its
+                     configured timeout.
+    '''
+    def __init__(self, state, timeout_s):
+        super(TransferTimeout, self).__init__("Timed out after %.1f s in state %s" % (timeout_s, state))
+        self.state = state
+        self.timeout_s = timeout_s
+
+
+class TransferAborted(motion_planner.MotionAborted):
+    '''
+    TransferAborted: Raised inside a wait, or instead of the next move, when the state
+                     machine has been stopped.
+    '''
+    pass
+
+
+class TransferStateMachine:
+    '''
+    TransferStateMachine: Runs the Robomet -> SRAS -> Robomet transfer cycle.
+
+    Instead of spinning on flags, every wait blocks on a condition variable that the
+    poller wakes through notify() as soon as a new status is available. Each state has
+    its own timeout so a missing handshake can't hang the daemon forever.
+
+    The machine only needs the three axis objects, the XY controller's DeviceIO and a
+    callable returning the current positions dictionary, so it can be driven headless
+    against mock Connection/Device objects.
+    '''
+    def __init__(self, x_axis, y_axis, z_axis, xy_io, get_positions,
+                 timeouts=None, park_delay_s=5.0, planner=None,
+                 approach_clearance_steps=DEFAULT_APPROACH_CLEARANCE_STEPS,
+                 on_state_change=None, on_cycle_complete=None, on_error=None, time_scale=1.0, trace=None):
+        self.x_axis = x_axis
+        self.y_axis = y_axis
+        self.z_axis = z_axis
+        self.xy_io = xy_io
+        self.get_positions = get_positions
+        if planner is None:
+            planner = motion_planner.MotionPlanner(x_axis, y_axis, z_axis, get_positions)
+        self.planner = planner
+        self.timeouts = dict(DEFAULT_STATE_TIMEOUTS)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.park_delay_s = park_delay_s
+        self.approach_clearance_steps = approach_clearance_steps
+        self.on_state_change = on_state_change
+        self.on_cycle_complete = on_cycle_complete
+        # Called as on_error(error) when an unexpected error ends auto mode
+        self.on_error = on_error
+        # Simulated seconds per wall-clock second. Delays and timeouts are given in
+        # simulated seconds and cycle times are reported in them.
+        self.time_scale = time_scale
+        # Optional TraceLog; each leg of the cycle is written to it as a "phase" span
+        self.trace = trace
+
+        self.state = IDLE
+        self.is_running = False
+        self.cycle_times = []
+        self.cycle_number = 0
+        self.scan_errors = 0
+        # Robomet transfer requests (rising edges of RTL) not yet served, oldest first
+        self.request_queue = collections.deque()
+        self.status = {"inputs": [False, False, False, False],
+                       "sras_inputs": [False, False, False, False],
+                       "at_home": False,
+                       "at_r3d_load": False,
+                       "at_xz_load": False,
+                       "at_sras_load": False}
+        self.status_condition = threading.Condition()
+        self.thread = None
+
+    def notify(self, **status):
+        '''
+        notify(): Called by the poller with the latest inputs / position flags. Wakes up
+                  any state currently waiting for a transition.
+        '''
+        with self.status_condition:
+            if "inputs" in status:
+                rtl_was_set = self.status["inputs"][RTL_INPUT]
+                if status["inputs"][RTL_INPUT] and not rtl_was_set:
+                    self.request_queue.append(time.monotonic())
+            self.status.update(status)
+            self.status_condition.notify_all()
+
+    def start(self):
+        self.is_running = True
+        self.planner.resume()
+        self.thread = threading.Thread(None, self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        with self.status_condition:
+            self.is_running = False
+            self.status_condition.notify_all()
+        # A move already under way finishes, but no further step of it is sent
+        self.planner.abort()
+
+    def check_running(self):
+        if not self.is_running:
+            raise TransferAborted()
+
+    def move_axis(self, axis_name, position):
+        '''
+        move_axis(): Single-axis move that is never sent once the machine was stopped.
+        '''
+        self.check_running()
+        self.planner.move_axis(axis_name, position)
+
+    def move_to_station(self, station):
+        self.check_running()
+        self.planner.move_to_station(station)
+
+    def set_state(self, state, message=None):
+        self.state = state
+        self.state_entered = time.monotonic()
+        if self.on_state_change is not None:
+            self.on_state_change(state, message)
+
+    def wait_for(self, predicate):
+        '''
+        wait_for(): Block until predicate(status) is true, the machine is stopped, or the
+                    timeout for the current state expires.
+        '''
+        timeout_s = self.timeouts.get(self.state)
+        with self.status_condition:
+            satisfied = self.status_condition.wait_for(
+                lambda: (not self.is_running) or predicate(self.status),
+                timeout_s / self.time_scale if timeout_s is not None else None)
+            if not self.is_running:
+                raise TransferAborted()
+            if not satisfied:
+                raise TransferTimeout(self.state, timeout_s)
+
+    def sleep(self, seconds):
+        '''
+        sleep(): Interruptible delay. Returns early (with TransferAborted) on stop().
+        '''
+        deadline = time.monotonic() + seconds / self.time_scale
+        with self.status_condition:
+            while self.is_running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.status_condition.wait(remaining)
+        raise TransferAborted()
+
+    def input_is(self, index, value):
+        return lambda status: status["inputs"][index] == value
+
+    def request_pending(self, status):
+        # A queued rising edge of RTL, or RTL already high, e.g. raised before auto mode
+        # was started and so never seen rising
+        return len(self.request_queue) > 0 or status["inputs"][RTL_INPUT]
+
+    def scan_finished(self, status):
+        return status["sras_inputs"][SCAN_COMPLETE_INPUT] or status["sras_inputs"][SCAN_ERROR_INPUT]
+
+    def wait_for_scan(self):
+        '''
+        wait_for_scan(): Wait for the SRAS to raise scan complete or scan error. Returns
+                         True on success, False on a scan error or a scan timeout; either
+                         way the sample still has to come back.
+        '''
+        try:
+            self.wait_for(self.scan_finished)
+        except TransferTimeout as timeout:
+            print(timeout)
+            return False
+        return not self.status["sras_inputs"][SCAN_ERROR_INPUT]
+
+    def run(self):
+        while self.is_running:
+            try:
+                self.run_cycle()
+            except (motion_planner.MotionAborted, serial_scheduler.MotionStopped):
+                break
+            except TransferTimeout as timeout:
+                print(timeout)
+                self.set_state(IDLE, "Transfer timed out in %s. Waiting for Robomet." % timeout.state)
+            except Exception as error:
+                self.fail(error)
+                return
+        self.set_state(IDLE, "Auto Mode Disabled")
+        print("daemon shutting down...")
+
+    def fail(self, error):
+        '''
+        fail(): An unexpected error (a failed command or move, a recipe missing a station)
+                ends auto mode: drop the SRAS complete/error flags, go back to IDLE with the
+                error as the message and tell on_error.
+        '''
+        print("auto mode stopped: %s: %s" % (type(error).__name__, error))
+        self.is_running = False
+        for channel in (SRAS_COMPLETE_OUTPUT, SRAS_ERROR_OUTPUT):
+            try:
+                self.xy_io.set_digital_output(channel, False)
+            except Exception as output_error:
+                print("could not clear output %d: %s" % (channel, output_error))
+        self.set_state(IDLE, "Auto Mode stopped by an error: %s: %s" % (type(error).__name__, error))
+        if self.on_error is not None:
+            self.on_error(error)
+
+    def phase(self, name):
+        '''
+        phase(): Trace span around one leg of the cycle; a no-op without a trace log.
+        '''
+        if self.trace is None:
+            return contextlib.nullcontext()
+        return self.trace.span("phase", name, self.time_scale, cycle=self.cycle_number)
+
+    def run_cycle(self):
+        '''
+        run_cycle(): Run one full transfer cycle. Returns the cycle time in seconds,
+                     measured from the Robomet request to the return to IDLE.
+        '''
+        positions = self.get_positions()
+
+        # wait for a robomet request (possibly queued during the previous cycle),
+        # then move to the loading position
+        self.set_state(IDLE, "Auto Mode. Waiting for Robomet.")
+        with self.phase("wait_for_request"):
+            self.wait_for(self.request_pending)
+            with self.status_condition:
+                if self.request_queue:
+                    self.request_queue.popleft()
+        self.cycle_number += 1
+        cycle_start = time.monotonic()
+
+        with self.phase("move_to_load"):
+            self.set_state(LOAD, "Request for SRAS. Moving to Load...")
+            self.move_to_station("robomet_load")
+
+        # Wait for the sample, then move to the XZ handoff position and make sure we
+        # actually got there
+        with self.phase("handoff"):
+            self.set_state(LOAD, "Waiting for All-Clear")
+            self.wait_for(self.input_is(RTS_INPUT, True))
+            self.set_state(HANDOFF, "All-Clear recieved. Shuttling to XZ")
+            self.move_to_station("xz_transfer")
+            self.wait_for(lambda status: status["at_xz_load"])
+
+        # Move to SRAS dropoff location
+        # TODO: Add gripper fire signal
+        with self.phase("sras_travel"):
+            self.set_state(SRAS, "Shuttling to SRAS System")
+            self.move_to_station("sras_load")
+            self.wait_for(lambda status: status["at_sras_load"])
+            self.move_axis('z', 0)
+
+        # The scan runs until the SRAS says it is done. Meanwhile, bring Z down to just
+        # above the sample so the pickup is short.
+        with self.phase("scan") as span_fields:
+            self.set_state(SCAN, "SRAS Scan Running")
+            if self.approach_clearance_steps is not None:
+                self.move_axis('z', max(0, positions["sras_load"]["zpos"] - self.approach_clearance_steps))
+            scan_ok = self.wait_for_scan()
+            if span_fields is not None:
+                span_fields["scan_ok"] = scan_ok
+        if not scan_ok:
+            self.scan_errors += 1
+            self.xy_io.set_digital_output(SRAS_ERROR_OUTPUT, True)
+
+        # Pick up the sample and move back to the robomet
+        with self.phase("return"):
+            self.set_state(RETURN, "Returning Sample..." if scan_ok else "SRAS Scan Failed. Returning Sample...")
+            self.move_axis('y', positions["sras_load"]["ypos"])
+            self.move_axis('z', positions["sras_load"]["zpos"])
+            self.sleep(0.5)
+            self.move_to_station("xz_transfer")
+            # TODO: gripper shutdown
+            self.wait_for(lambda status: status["at_xz_load"])
+            self.move_to_station("robomet_load")
+
+        with self.phase("pickup"):
+            self.set_state(PICKUP, "Waiting for Robomet Pickup")
+            self.wait_for(lambda status: status["at_r3d_load"])
+            if scan_ok:
+                self.xy_io.set_digital_output(SRAS_COMPLETE_OUTPUT, True)
+                self.sleep(1.0)
+                self.xy_io.set_digital_output(SRAS_COMPLETE_OUTPUT, False)
+            self.wait_for(self.input_is(RTS_INPUT, False))
+            # The error flag stays up until the Robomet has taken the failed sample back
+            self.xy_io.set_digital_output(SRAS_ERROR_OUTPUT, False)
+
+        # Park out of the way unless the next request is already queued, in which case
+        # the stage is already where the next cycle starts.
+        with self.phase("park"):
+            with self.status_condition:
+                next_request = self.status_condition.wait_for(
+                    lambda: (not self.is_running) or self.request_pending(self.status),
+                    self.park_delay_s / self.time_scale)
+            self.check_running()
+            if not next_request:
+                self.move_axis('x', 0)
+
+        cycle_time = (time.monotonic() - cycle_start) * self.time_scale
+        self.cycle_times.append(cycle_time)
+        if self.trace is not None:
+            self.trace.write("cycle", cycle=self.cycle_number, duration_s=cycle_time, scan_ok=scan_ok)
+        if self.on_cycle_complete is not None:
+            self.on_cycle_complete(cycle_time)
+        return cycle_time
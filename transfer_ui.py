@@ -0,0 +1,369 @@
+import sys
+from PyQt5 import QtWidgets, uic, QtGui, QtCore
+import control_ipc
+
+
+class Ui(QtWidgets.QMainWindow):
+    '''
+    Ui: Operator window. A thin client of the transfer controller daemon; every action
+        is a request over control_ipc and the display follows the daemon's events.
+    '''
+    # Emitted from the IPC reader thread; Qt queues the call onto the GUI thread.
+    snapshot_ready = QtCore.pyqtSignal(object)
+    status_message = QtCore.pyqtSignal(str)
+    positions_changed = QtCore.pyqtSignal(object)
+    ports_discovered = QtCore.pyqtSignal(object)
+    connection_changed = QtCore.pyqtSignal(object)
+
+    def __init__(self, client):
+        super(Ui, self).__init__()
+        uic.loadUi('transfer_ui.ui', self)
+        self.show()
+        self.client = client
+
+        # Fonts for the I/O indicator labels are built once and reused on every refresh
+        self.font_signal_on = QtGui.QFont("MS Shell Dlg 2", 8, QtGui.QFont.Bold)
+        self.font_signal_off = QtGui.QFont("MS Shell Dlg 2", 8, QtGui.QFont.Medium)
+        # Last value shown by each display widget, so unchanged labels are not repainted
+        self.displayed_values = {}
+        self.repaint_count = 0
+
+        self.current_comport = ''
+        self.SYSTEM_STATE = 'STARTUP'
+        self.positions = {}
+        self.xaxis_steps = 0
+        self.yaxis_steps = 0
+        self.zaxis_steps = 0
+        self.is_in_automode = False
+
+        # signal and slot definitions
+        self.snapshot_ready.connect(self.refresh_display)
+        self.status_message.connect(self.label_system_state.setText)
+        self.positions_changed.connect(self.show_positions)
+        self.ports_discovered.connect(self.show_discovered_ports)
+        self.connection_changed.connect(self.show_connection)
+        self.button_comconnect.clicked.connect(self.connect_com_port)
+        self.btn_r3dh_sync.clicked.connect(self.read_encoder_position_r3dh)
+        self.btn_stp_sync.clicked.connect(self.read_encoder_position_stp)
+        self.btn_sdp_sync.clicked.connect(self.read_encoder_position_sdp)
+
+        # Save buttons
+        self.btn_r3dh_save.clicked.connect(self.save_positions)
+        self.btn_stp_save.clicked.connect(self.save_positions)
+        self.btn_sdp_save.clicked.connect(self.save_positions)
+
+        # Auto Button
+        self.btn_auto_toggle.clicked.connect(self.toggle_auto_mode)
+
+        self.client.on_event = self.handle_daemon_event
+        daemon_status = self.client.subscribe()
+        # Set system state to the idling / disconnected state
+        if self.SYSTEM_STATE == 'STARTUP':
+            self.set_ui_state()
+            self.enumerate_com_ports()
+            if daemon_status["positions_file_found"]:
+                self.statusBar().showMessage("Loaded saved positions, recipe '%s'." % daemon_status["recipe"])
+            else:
+                self.statusBar().showMessage("transfer_positions.json was not found. An empty one has been "
+                                             "created. You'll need to save new positions.")
+        # The daemon may already be running a connected cell
+        if daemon_status["system_state"] == 'ONLINE':
+            self.is_in_automode = daemon_status["auto_mode"]
+            self.show_connection(daemon_status)
+            self.label_system_state.setText(daemon_status["message"])
+
+    def handle_daemon_event(self, event, data):
+        # Called on the IPC reader thread
+        if event == "snapshot":
+            self.snapshot_ready.emit(data)
+        elif event == "status_message":
+            self.status_message.emit(data)
+        elif event == "positions":
+            self.positions_changed.emit(data)
+        elif event == "ports":
+            self.ports_discovered.emit(data)
+        elif event == "connection":
+            self.connection_changed.emit(data)
+
+    def set_ui_state(self):
+        '''
+        set_ui_state: Display "Not connected" text and disable all UI
+                                elements with the exception of the COM connection controls
+        '''
+        if (self.SYSTEM_STATE == 'OFFLINE') or (self.SYSTEM_STATE == 'STARTUP'):
+            self.label_system_state.setText("Not Connected")
+            self.xaxis_counts.setEnabled(False)
+            self.xaxis_mm.setEnabled(False)
+            self.yaxis_counts.setEnabled(False)
+            self.yaxis_mm.setEnabled(False)
+            self.zaxis_counts.setEnabled(False)
+            self.zaxis_mm.setEnabled(False)
+            self.label_rtl_signal.setEnabled(False)
+            self.label_rts_signal.setEnabled(False)
+            self.label_r3dsafe.setEnabled(False)
+            self.label_srasready_signal.setEnabled(False)
+            self.label_ctl_signal.setEnabled(False)
+            self.label_srascomplete_signal.setEnabled(False)
+            self.label_sraserror_signal.setEnabled(False)
+            self.label_scancomplete_signal.setEnabled(False)
+            self.label_scanerror_signal.setEnabled(False)
+            self.txt_r3dh_x.setEnabled(False)
+            self.txt_r3dh_y.setEnabled(False)
+            self.txt_r3dh_z.setEnabled(False)
+            self.btn_r3dh_sync.setEnabled(False)
+            self.btn_r3dh_save.setEnabled(False)
+            self.txt_stp_x.setEnabled(False)
+            self.txt_stp_y.setEnabled(False)
+            self.txt_stp_z.setEnabled(False)
+            self.btn_stp_sync.setEnabled(False)
+            self.btn_stp_save.setEnabled(False)
+            self.txt_sdp_x.setEnabled(False)
+            self.txt_sdp_y.setEnabled(False)
+            self.txt_sdp_z.setEnabled(False)
+            self.btn_sdp_sync.setEnabled(False)
+            self.btn_sdp_save.setEnabled(False)
+            self.btn_auto_toggle.setEnabled(False)
+        elif self.SYSTEM_STATE == "ONLINE":
+            self.label_system_state.setText("Connected. Not Homed.")
+            self.xaxis_counts.setEnabled(True)
+            self.xaxis_mm.setEnabled(True)
+            self.yaxis_counts.setEnabled(True)
+            self.yaxis_mm.setEnabled(True)
+            self.zaxis_counts.setEnabled(True)
+            self.zaxis_mm.setEnabled(True)
+            self.label_rtl_signal.setEnabled(True)
+            self.label_rts_signal.setEnabled(True)
+            self.label_r3dsafe.setEnabled(True)
+            self.label_srasready_signal.setEnabled(True)
+            self.label_ctl_signal.setEnabled(True)
+            self.label_srascomplete_signal.setEnabled(True)
+            self.label_sraserror_signal.setEnabled(True)
+            self.label_scancomplete_signal.setEnabled(True)
+            self.label_scanerror_signal.setEnabled(True)
+            self.txt_r3dh_x.setEnabled(True)
+            self.txt_r3dh_y.setEnabled(True)
+            self.txt_r3dh_z.setEnabled(True)
+            self.btn_r3dh_sync.setEnabled(True)
+            self.btn_r3dh_save.setEnabled(True)
+            self.txt_stp_x.setEnabled(True)
+            self.txt_stp_y.setEnabled(True)
+            self.txt_stp_z.setEnabled(True)
+            self.btn_stp_sync.setEnabled(True)
+            self.btn_stp_save.setEnabled(True)
+            self.txt_sdp_x.setEnabled(True)
+            self.txt_sdp_y.setEnabled(True)
+            self.txt_sdp_z.setEnabled(True)
+            self.btn_sdp_sync.setEnabled(True)
+            self.btn_sdp_save.setEnabled(True)
+            self.btn_auto_toggle.setEnabled(True)
+        return
+
+    def enumerate_com_ports(self):
+        '''
+        enumerate_com_ports(): Fill the port list, ports the daemon last found Zaber
+                               controllers on first.
+        '''
+        try:
+            possible_ports = self.client.request("list_ports")
+        except (control_ipc.ControlError, OSError) as error:
+            self.report_error("Listing serial ports", error)
+            return
+        self.combo_comselect.clear()
+        for current_port in possible_ports:
+            self.combo_comselect.addItem(current_port)
+
+    def report_error(self, action, error):
+        '''
+        report_error(): Show a failed daemon request in the status bar.
+        '''
+        self.statusBar().showMessage("%s failed: %s" % (action, error))
+
+    def show_discovered_ports(self, results):
+        '''
+        show_discovered_ports(): Slot for ports_discovered. A background probe finished;
+                                 refresh the list unless we are already connected.
+        '''
+        found = sorted(port for port, result in results.items() if result["zaber"])
+        if self.SYSTEM_STATE != 'ONLINE':
+            self.enumerate_com_ports()
+        self.statusBar().showMessage("Zaber controllers found on: " + (", ".join(found) or "no port"), 5000)
+
+    def show_connection(self, connection):
+        '''
+        show_connection(): Slot for connection_changed. Follow the daemon's connection
+                           state, whoever connected or disconnected the cell.
+        '''
+        if connection["system_state"] == self.SYSTEM_STATE:
+            return
+        if connection["system_state"] == 'ONLINE':
+            self.current_comport = connection["comport"]
+            self.SYSTEM_STATE = 'ONLINE'
+            self.set_ui_state()
+            self.button_comconnect.setText("Disconnect Transfer Controller")
+            try:
+                self.populate_position_fields(self.client.request("get_positions"))
+            except (control_ipc.ControlError, OSError) as error:
+                self.report_error("Reading positions", error)
+        else:
+            self.SYSTEM_STATE = 'OFFLINE'
+            self.is_in_automode = False
+            self.set_ui_state()
+            self.button_comconnect.setText("Connect to Transfer Controller")
+            self.enumerate_com_ports()
+
+    def connect_com_port(self):
+        if self.button_comconnect.text() == "Connect to Transfer Controller":
+            combobox_string = self.combo_comselect.currentText()
+            self.current_comport = combobox_string.split(' ')[0]
+            self.statusBar().showMessage("Connecting to " + self.current_comport + "...")
+            try:
+                self.client.request("connect", port=self.current_comport)
+            except (control_ipc.ControlError, OSError) as error:
+                self.report_error("Connecting to " + self.current_comport, error)
+                QtWidgets.QMessageBox.critical(self, "Connection Failed", error.__str__())
+                return
+            self.show_connection({"system_state": 'ONLINE', "comport": self.current_comport})
+        else:
+            try:
+                self.client.request("disconnect")
+            except (control_ipc.ControlError, OSError) as error:
+                self.report_error("Disconnecting", error)
+                return
+            self.show_connection({"system_state": 'OFFLINE', "comport": self.current_comport})
+            try:
+                self.client.request("discover_ports")
+            except (control_ipc.ControlError, OSError) as error:
+                self.report_error("Port discovery", error)
+        return
+
+    def refresh_display(self, snapshot):
+        '''
+        refresh_display(): Slot for snapshot_ready, runs on the GUI thread. Only widgets
+                           whose value changed since the last snapshot are updated.
+        '''
+        self.xaxis_steps = snapshot["x"]
+        self.yaxis_steps = snapshot["y"]
+        self.zaxis_steps = snapshot["z"]
+        self.update_counts_label(self.xaxis_counts, snapshot["x"])
+        self.update_counts_label(self.yaxis_counts, snapshot["y"])
+        self.update_counts_label(self.zaxis_counts, snapshot["z"])
+        # Converted by the daemon with the calibration it read at connect
+        if snapshot["x_mm"] is not None:
+            self.update_mm_label(self.xaxis_mm, snapshot["x_mm"])
+            self.update_mm_label(self.yaxis_mm, snapshot["y_mm"])
+            self.update_mm_label(self.zaxis_mm, snapshot["z_mm"])
+        self.update_signal_label(self.label_rtl_signal, snapshot["xy_inputs"][0])
+        self.update_signal_label(self.label_rts_signal, snapshot["xy_inputs"][1])
+        self.update_signal_label(self.label_r3dsafe, snapshot["xy_inputs"][2])
+        self.update_signal_label(self.label_srasready_signal, snapshot["xy_outputs"][0])
+        self.update_signal_label(self.label_ctl_signal, snapshot["xy_outputs"][1])
+        self.update_signal_label(self.label_srascomplete_signal, snapshot["xy_outputs"][2])
+        self.update_signal_label(self.label_sraserror_signal, snapshot["xy_outputs"][3])
+        # Scan complete / scan error come from the SRAS on the Z controller's inputs 1 and 2
+        self.update_signal_label(self.label_scancomplete_signal, snapshot["z_inputs"][0])
+        self.update_signal_label(self.label_scanerror_signal, snapshot["z_inputs"][1])
+
+    def update_counts_label(self, label, counts):
+        if self.displayed_values.get(label) != counts:
+            self.displayed_values[label] = counts
+            label.setText(counts.__str__())
+            self.repaint_count += 1
+
+    def update_mm_label(self, label, mm):
+        # Compare the shown text, so changes below the display resolution cost no repaint
+        text = "%.3f" % mm
+        if self.displayed_values.get(label) != text:
+            self.displayed_values[label] = text
+            label.setText(text)
+            self.repaint_count += 1
+
+    def update_signal_label(self, label, is_on):
+        if self.displayed_values.get(label) != is_on:
+            self.displayed_values[label] = is_on
+            label.setFont(self.font_signal_on if is_on else self.font_signal_off)
+            self.repaint_count += 1
+    
+    def save_positions(self):
+        try:
+            positions = {"robomet_load": {"xpos": round(float(self.txt_r3dh_x.text())),
+                                          "ypos": round(float(self.txt_r3dh_y.text())),
+                                          "zpos": round(float(self.txt_r3dh_z.text()))},
+                         "xz_transfer": {"xpos": round(float(self.txt_stp_x.text())),
+                                         "ypos": round(float(self.txt_stp_y.text())),
+                                         "zpos": round(float(self.txt_stp_z.text()))},
+                         "sras_load": {"xpos": round(float(self.txt_sdp_x.text())),
+                                       "ypos": round(float(self.txt_sdp_y.text())),
+                                       "zpos": round(float(self.txt_sdp_z.text()))}}
+        except ValueError:
+            self.statusBar().showMessage("Positions must be numbers; nothing was saved.")
+            return
+        try:
+            saved = self.client.request("set_positions", positions=positions)
+        except (control_ipc.ControlError, OSError) as error:
+            self.report_error("Saving positions", error)
+            return
+        self.positions = positions
+        self.statusBar().showMessage("Positions saved to recipe '%(recipe)s', version %(version)d." % saved, 5000)
+        return
+
+    def show_positions(self, data):
+        '''
+        show_positions(): Slot for positions_changed. Another client saved positions or
+                          switched the recipe.
+        '''
+        self.populate_position_fields(data["stations"])
+        self.statusBar().showMessage("Recipe '%s' active." % data["recipe"], 5000)
+
+    def populate_position_fields(self, positions):
+        # Populate text boxes with current values
+        self.positions = positions
+        self.txt_r3dh_x.setText(self.positions["robomet_load"]["xpos"].__str__())
+        self.txt_r3dh_y.setText(self.positions["robomet_load"]["ypos"].__str__())
+        self.txt_r3dh_z.setText(self.positions["robomet_load"]["zpos"].__str__())
+        
+        self.txt_stp_x.setText(self.positions["xz_transfer"]["xpos"].__str__())
+        self.txt_stp_y.setText(self.positions["xz_transfer"]["ypos"].__str__())
+        self.txt_stp_z.setText(self.positions["xz_transfer"]["zpos"].__str__())
+
+        self.txt_sdp_x.setText(self.positions["sras_load"]["xpos"].__str__())
+        self.txt_sdp_y.setText(self.positions["sras_load"]["ypos"].__str__())
+        self.txt_sdp_z.setText(self.positions["sras_load"]["zpos"].__str__())
+        return
+
+    def read_encoder_position_r3dh(self):
+        self.txt_r3dh_x.setText(self.xaxis_steps.__str__())
+        self.txt_r3dh_y.setText(self.yaxis_steps.__str__())
+        self.txt_r3dh_z.setText(self.zaxis_steps.__str__())
+        return
+
+    def read_encoder_position_stp(self):
+        self.txt_stp_x.setText(self.xaxis_steps.__str__())
+        self.txt_stp_y.setText(self.yaxis_steps.__str__())
+        self.txt_stp_z.setText(self.zaxis_steps.__str__())
+        
+    def read_encoder_position_sdp(self):
+        self.txt_sdp_x.setText(self.xaxis_steps.__str__())
+        self.txt_sdp_y.setText(self.yaxis_steps.__str__())
+        self.txt_sdp_z.setText(self.zaxis_steps.__str__())
+
+    def toggle_auto_mode(self):
+
+        try:
+            if(self.is_in_automode == False):
+                self.is_in_automode = self.client.request("set_auto_mode", enabled=True)
+            else:
+                self.is_in_automode = self.client.request("set_auto_mode", enabled=False)
+                self.statusBar().showMessage("Auto mode off. Display repaints so far: %d" % self.repaint_count, 5000)
+        except (control_ipc.ControlError, OSError) as error:
+            self.report_error("Switching auto mode", error)
+
+
+def run_gui(host=control_ipc.DEFAULT_HOST, port=control_ipc.DEFAULT_PORT, cell=None):
+    app = QtWidgets.QApplication(sys.argv)
+    client = control_ipc.ControlClient(host, port, cell=cell)
+    window = Ui(client)
+    if cell is not None:
+        window.setWindowTitle(window.windowTitle() + " - " + cell)
+    result = app.exec_()
+    client.close()
+    return result
@@ -0,0 +1,91 @@
+COUNTS = 'counts'
+MM = 'mm'
+UNITS = (COUNTS, MM)
+AXES = ('x', 'y', 'z')
+# Station dict key for each axis, as stored in transfer_positions.json
+STATION_KEYS = {'x': "xpos", 'y': "ypos", 'z': "zpos"}
+
+
+def check_unit(unit):
+    if unit not in UNITS:
+        raise ValueError("Unknown unit %r, expected one of %s" % (unit, ", ".join(UNITS)))
+    return unit
+
+
+def check_tolerance(tolerance):
+    '''
+    check_tolerance(): tolerance as a tuple, if it is exactly one positive number per axis
+                       (x, y, z). Raises ValueError otherwise.
+    '''
+    try:
+        tolerance = tuple(tolerance)
+    except TypeError:
+        raise ValueError("Tolerance must be one value per axis (x, y, z), got %r" % (tolerance,))
+    if len(tolerance) != len(AXES):
+        raise ValueError("Tolerance must be one value per axis (x, y, z), got %r" % (tolerance,))
+    for value in tolerance:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+            raise ValueError("Tolerance values must be positive numbers, got %r" % (tolerance,))
+    return tolerance
+
+
+class AxisUnits:
+    '''
+    AxisUnits: Counts <-> millimetre conversion for the x, y and z axes.
+
+    The scale of each axis (counts per mm, which folds in its microstep size and
+    resolution) is read from the device once, at connect, by from_axes(). After that every
+    conversion is a multiplication; nothing here talks to the port, so converting each
+    poll snapshot costs no extra serial traffic. Positions are always stored, matched and
+    commanded in counts; mm only exists at the edges (the display and the IPC).
+    '''
+    def __init__(self, counts_per_mm):
+        self.counts_per_mm = dict(counts_per_mm)
+        self.mm_per_count = dict((axis, 1.0 / scale) for axis, scale in self.counts_per_mm.items())
+
+    @classmethod
+    def from_axes(cls, axes, millimetres):
+        '''
+        from_axes(): Read the calibration of {axis name: Axis}. millimetres is the
+                     zaber_motion Units.LENGTH_MILLIMETRES (or the simulator's stand-in).
+        '''
+        return cls(dict((name, axis.settings.convert_to_native_units("pos", 1.0, millimetres))
+                        for name, axis in axes.items()))
+
+    def to_mm(self, axis, counts):
+        return counts * self.mm_per_count[axis]
+
+    def to_counts(self, axis, value, unit=MM):
+        '''
+        to_counts(): value in unit as a whole number of counts on axis.
+        '''
+        if check_unit(unit) == COUNTS:
+            return int(round(value))
+        return int(round(value * self.counts_per_mm[axis]))
+
+    def from_counts(self, axis, counts, unit=MM):
+        if check_unit(unit) == COUNTS:
+            return counts
+        return counts * self.mm_per_count[axis]
+
+    def snapshot_mm(self, x, y, z):
+        '''
+        snapshot_mm(): One poll snapshot's positions in mm, as (x, y, z).
+        '''
+        return (x * self.mm_per_count['x'], y * self.mm_per_count['y'], z * self.mm_per_count['z'])
+
+    def stations_to_counts(self, stations, unit=MM):
+        return dict((station, dict((STATION_KEYS[axis], self.to_counts(axis, position[STATION_KEYS[axis]], unit))
+                                   for axis in AXES))
+                    for station, position in stations.items())
+
+    def stations_from_counts(self, stations, unit=MM):
+        return dict((station, dict((STATION_KEYS[axis], self.from_counts(axis, position[STATION_KEYS[axis]], unit))
+                                   for axis in AXES))
+                    for station, position in stations.items())
+
+    def tolerance_to_counts(self, tolerance, unit=MM):
+        '''
+        tolerance_to_counts(): Per-axis (x, y, z) window in unit as counts.
+        '''
+        return tuple(self.to_counts(axis, value, unit) for axis, value in zip(AXES, check_tolerance(tolerance)))
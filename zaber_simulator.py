@@ -0,0 +1,422 @@
+'''
+zaber_simulator.py: Simulated stand-in for zaber_motion's Connection / Device / Axis /
+                    DeviceIO, plus scripted Robomet and SRAS peers, for running the
+                    transfer controller without the rig.
+
+Open it like a serial port:
+    SimulatedConnection.open_serial_port("SIM")        real time
+    SimulatedConnection.open_serial_port("SIM@100")    100x faster than real time
+
+All kinematics and peer timings run on a SimClock, so at a time scale of 100 a 10 s scan
+takes 0.1 s of wall time. Components that wait on their own (the state machine, the
+poller) read connection.time_scale to scale their delays to match.
+'''
+import collections
+import math
+import random
+import threading
+import time
+
+SIM_PORT_PREFIX = "SIM"
+
+# XY controller inputs (from the Robomet) and outputs, 0-based
+RTL_INPUT = 0
+RTS_INPUT = 1
+R3D_SAFE_INPUT = 2
+SRAS_READY_OUTPUT = 0
+CTL_OUTPUT = 1
+SRAS_COMPLETE_OUTPUT = 2
+SRAS_ERROR_OUTPUT = 3
+# Z controller inputs (from the SRAS), 0-based
+SCAN_COMPLETE_INPUT = 0
+SCAN_ERROR_INPUT = 1
+
+# Stands in for zaber_motion's Units.LENGTH_MILLIMETRES when talking to the simulator
+MILLIMETRES = 'mm'
+# Microstep size of a typical Zaber lead-screw stage (0.047625 um per microstep)
+DEFAULT_COUNTS_PER_MM = 1 / 0.000047625
+
+# Same shape as zaber_motion.ascii.Response for the fields the poller uses
+SimResponse = collections.namedtuple('SimResponse', ['device_address', 'axis_number', 'reply_flag',
+                                                     'status', 'warning_flag', 'data', 'message_type'])
+
+
+def is_simulated_port(port):
+    return port.upper().startswith(SIM_PORT_PREFIX)
+
+
+class SimClock:
+    '''
+    SimClock: Simulated seconds, running time_scale times faster than the wall clock.
+    '''
+    def __init__(self, time_scale=1.0):
+        self.time_scale = float(time_scale)
+        self.start = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self.start) * self.time_scale
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.time_scale)
+
+
+class SimAxisSettings:
+    '''
+    SimAxisSettings: The unit conversion part of zaber_motion's AxisSettings; only
+                     positions in millimetres are supported.
+    '''
+    def __init__(self, counts_per_mm):
+        self.counts_per_mm = counts_per_mm
+
+    def convert_to_native_units(self, setting, value, unit):
+        if setting != "pos" or unit != MILLIMETRES:
+            raise ValueError("Simulator only converts pos in %s" % MILLIMETRES)
+        return value * self.counts_per_mm
+
+
+class SimAxis:
+    '''
+    SimAxis: One stepper axis with a trapezoidal velocity profile (max speed and
+             acceleration in counts/s and counts/s^2). Moves start from rest at the current
+             position; a new move or stop() cuts the previous one short.
+    '''
+    def __init__(self, clock, axis_number, max_speed=200000.0, acceleration=1000000.0,
+                 position=0, homed=False, counts_per_mm=DEFAULT_COUNTS_PER_MM):
+        self.clock = clock
+        self.settings = SimAxisSettings(counts_per_mm)
+        self.axis_number = axis_number
+        self.max_speed = float(max_speed)
+        self.acceleration = float(acceleration)
+        self.lock = threading.Lock()
+        self.start_position = float(position)
+        self.target = float(position)
+        self.move_start = 0.0
+        self.move_time = 0.0
+        self.ramp_time = 0.0
+        self.peak_speed = 0.0
+        self.homed = homed
+
+    def profile_position(self, now):
+        elapsed = now - self.move_start
+        if elapsed >= self.move_time:
+            return self.target
+        direction = 1.0 if self.target >= self.start_position else -1.0
+        if elapsed <= self.ramp_time:
+            travelled = 0.5 * self.acceleration * elapsed ** 2
+        elif elapsed <= self.move_time - self.ramp_time:
+            travelled = (0.5 * self.acceleration * self.ramp_time ** 2 +
+                         self.peak_speed * (elapsed - self.ramp_time))
+        else:
+            remaining = self.move_time - elapsed
+            travelled = abs(self.target - self.start_position) - 0.5 * self.acceleration * remaining ** 2
+        return self.start_position + direction * travelled
+
+    def start_move(self, target):
+        with self.lock:
+            now = self.clock.now()
+            self.start_position = self.profile_position(now)
+            self.target = float(target)
+            self.move_start = now
+            distance = abs(self.target - self.start_position)
+            ramp_time = self.max_speed / self.acceleration
+            ramp_distance = 0.5 * self.acceleration * ramp_time ** 2
+            if 2 * ramp_distance >= distance:
+                # Triangular profile; never reaches max speed
+                self.ramp_time = math.sqrt(distance / self.acceleration)
+                self.peak_speed = self.acceleration * self.ramp_time
+                self.move_time = 2 * self.ramp_time
+            else:
+                self.ramp_time = ramp_time
+                self.peak_speed = self.max_speed
+                self.move_time = 2 * ramp_time + (distance - 2 * ramp_distance) / self.max_speed
+
+    def move_absolute(self, position, wait_until_idle=True):
+        self.start_move(position)
+        if wait_until_idle:
+            self.wait_until_idle()
+
+    def move_relative(self, position, wait_until_idle=True):
+        self.move_absolute(self.get_position() + position, wait_until_idle)
+
+    def home(self, wait_until_idle=True):
+        self.start_move(0)
+        self.homed = True
+        if wait_until_idle:
+            self.wait_until_idle()
+
+    def stop(self, wait_until_idle=True):
+        with self.lock:
+            position = self.profile_position(self.clock.now())
+            self.start_position = self.target = position
+            self.move_time = 0.0
+
+    def is_busy(self):
+        with self.lock:
+            return self.clock.now() - self.move_start < self.move_time
+
+    def is_homed(self):
+        return self.homed
+
+    def wait_until_idle(self, throw_error_on_fault=True):
+        while True:
+            with self.lock:
+                remaining = self.move_start + self.move_time - self.clock.now()
+            if remaining <= 0:
+                return
+            self.clock.sleep(remaining)
+
+    def get_position(self, unit=None):
+        with self.lock:
+            return float(round(self.profile_position(self.clock.now())))
+
+
+class SimDeviceIO:
+    '''
+    SimDeviceIO: Four digital inputs (driven by the peers) and four digital outputs
+                 (driven by the controller). Channels are 1-based like DeviceIO.
+    '''
+    def __init__(self, channel_count=4):
+        self.lock = threading.Lock()
+        self.inputs = [False] * channel_count
+        self.outputs = [False] * channel_count
+
+    def get_all_digital_inputs(self):
+        with self.lock:
+            return list(self.inputs)
+
+    def get_all_digital_outputs(self):
+        with self.lock:
+            return list(self.outputs)
+
+    def get_digital_input(self, channel):
+        with self.lock:
+            return self.inputs[channel - 1]
+
+    def get_digital_output(self, channel):
+        with self.lock:
+            return self.outputs[channel - 1]
+
+    def set_digital_output(self, channel, value):
+        with self.lock:
+            self.outputs[channel - 1] = bool(value)
+
+    def set_all_digital_outputs(self, values):
+        with self.lock:
+            self.outputs = [bool(value) for value in values]
+
+    def set_input(self, index, value):
+        # Peer side: drive an input line (0-based)
+        with self.lock:
+            self.inputs[index] = bool(value)
+
+
+class SimDevice:
+    def __init__(self, device_address, axes):
+        self.device_address = device_address
+        self.axes = axes
+        self.io = SimDeviceIO()
+
+    def get_axis(self, axis_number):
+        return self.axes[axis_number - 1]
+
+    def is_busy(self):
+        return any(axis.is_busy() for axis in self.axes)
+
+
+class SimulatedConnection:
+    '''
+    SimulatedConnection: Device 1 is the two-axis XY controller, device 2 the one-axis Z
+                         controller. Each command costs command_latency_s of simulated time
+                         to stand in for the serial round trip.
+    '''
+    def __init__(self, time_scale=1.0, command_latency_s=0.004, axis_kinematics=None):
+        self.clock = SimClock(time_scale)
+        self.time_scale = self.clock.time_scale
+        self.command_latency_s = command_latency_s
+        self.command_lock = threading.Lock()
+        self.command_count = 0
+        kinematics = {'x': (200000.0, 1000000.0), 'y': (200000.0, 1000000.0), 'z': (400000.0, 2000000.0)}
+        if axis_kinematics is not None:
+            kinematics.update(axis_kinematics)
+        self.devices = {1: SimDevice(1, [SimAxis(self.clock, 1, *kinematics['x']),
+                                         SimAxis(self.clock, 2, *kinematics['y'])]),
+                        2: SimDevice(2, [SimAxis(self.clock, 1, *kinematics['z'])])}
+        self.peers = []
+        self.is_open = True
+
+    @classmethod
+    def open_serial_port(cls, port_name, baud_rate=115200, direct=False):
+        '''
+        open_serial_port(): "SIM" or "SIM@<time scale>".
+        '''
+        time_scale = 1.0
+        if '@' in port_name:
+            time_scale = float(port_name.split('@', 1)[1])
+        return cls(time_scale)
+
+    def serial_round_trip(self):
+        with self.command_lock:
+            self.command_count += 1
+            self.clock.sleep(self.command_latency_s)
+
+    def get_device(self, device_address):
+        return self.devices[device_address]
+
+    def generic_command_multi_response(self, command, device=0, axis=0, check_errors=True, timeout=0):
+        self.serial_round_trip()
+        responses = []
+        for address, sim_device in sorted(self.devices.items()):
+            if device and address != device:
+                continue
+            if command == "get pos":
+                data = ' '.join("%d" % sim_axis.get_position() for sim_axis in sim_device.axes)
+            elif command == "io get di":
+                data = ' '.join('1' if value else '0' for value in sim_device.io.get_all_digital_inputs())
+            elif command == "io get do":
+                data = ' '.join('1' if value else '0' for value in sim_device.io.get_all_digital_outputs())
+            elif command == "get system.axiscount":
+                data = "%d" % len(sim_device.axes)
+            else:
+                raise ValueError("Simulator does not support command: " + command)
+            responses.append(SimResponse(address, 0, 'OK', 'BUSY' if sim_device.is_busy() else 'IDLE',
+                                         '--', data, 'REPLY'))
+        return responses
+
+    def stop_all(self, wait_until_idle=True):
+        for sim_device in self.devices.values():
+            for sim_axis in sim_device.axes:
+                sim_axis.stop()
+
+    def add_peer(self, peer):
+        self.peers.append(peer)
+        peer.start()
+        return peer
+
+    def close(self):
+        self.is_open = False
+        for peer in self.peers:
+            peer.stop()
+
+
+class SimPeer:
+    '''
+    SimPeer: Base for the scripted machines on the other end of the I/O lines. step() is
+             called every step_s of simulated time on the peer's own thread.
+    '''
+    step_s = 0.010
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.clock = connection.clock
+        self.xy_io = connection.get_device(1).io
+        self.z_io = connection.get_device(2).io
+        self.is_running = False
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(None, self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+
+    def run(self):
+        while self.is_running:
+            self.step(self.clock.now())
+            self.clock.sleep(self.step_s)
+
+    def stage_position(self):
+        return (self.connection.get_device(1).get_axis(1).get_position(),
+                self.connection.get_device(1).get_axis(2).get_position(),
+                self.connection.get_device(2).get_axis(1).get_position())
+
+
+class RobometPeer(SimPeer):
+    '''
+    RobometPeer: Requests a transfer (RTL), hands the sample over handoff_s after the
+                 controller signals clear-to-load (RTS), and takes the sample back
+                 pickup_s after the SRAS-complete pulse or the SRAS-error flag. Keeps R3D
+                 safety OK asserted.
+    '''
+    def __init__(self, connection, handoff_s=2.0, pickup_s=2.0, next_request_s=1.0):
+        SimPeer.__init__(self, connection)
+        self.handoff_s = handoff_s
+        self.pickup_s = pickup_s
+        self.next_request_s = next_request_s
+        self.phase = 'WAIT_BEFORE_REQUEST'
+        self.phase_started = self.clock.now()
+        self.samples_returned = 0
+        self.xy_io.set_input(R3D_SAFE_INPUT, True)
+
+    def enter(self, phase, now):
+        self.phase = phase
+        self.phase_started = now
+
+    def step(self, now):
+        outputs = self.xy_io.get_all_digital_outputs()
+        in_phase_s = now - self.phase_started
+        if self.phase == 'WAIT_BEFORE_REQUEST' and in_phase_s >= self.next_request_s:
+            self.xy_io.set_input(RTL_INPUT, True)
+            self.enter('REQUESTED', now)
+        elif self.phase == 'REQUESTED' and outputs[CTL_OUTPUT]:
+            self.enter('HANDING_OFF', now)
+        elif self.phase == 'HANDING_OFF' and in_phase_s >= self.handoff_s:
+            self.xy_io.set_input(RTS_INPUT, True)
+            self.enter('SAMPLE_AWAY', now)
+        elif self.phase == 'SAMPLE_AWAY' and (outputs[SRAS_COMPLETE_OUTPUT] or outputs[SRAS_ERROR_OUTPUT]):
+            self.enter('PICKING_UP', now)
+        elif self.phase == 'PICKING_UP' and in_phase_s >= self.pickup_s:
+            self.xy_io.set_input(RTL_INPUT, False)
+            self.xy_io.set_input(RTS_INPUT, False)
+            self.samples_returned += 1
+            self.enter('WAIT_BEFORE_REQUEST', now)
+
+
+class SrasPeer(SimPeer):
+    '''
+    SrasPeer: Watches the stages. Once the sample has been set down at the SRAS load
+              position and Z has retracted, it scans for scan_s and then raises scan
+              complete (or scan error, with probability error_rate) on the Z controller's
+              inputs. Both lines drop when the sample is picked up again.
+    '''
+    def __init__(self, connection, sras_position, scan_s=10.0, error_rate=0.0,
+                 tolerance=200, seed=None):
+        SimPeer.__init__(self, connection)
+        self.sras_position = sras_position
+        self.scan_s = scan_s
+        self.error_rate = error_rate
+        self.tolerance = tolerance
+        self.random = random.Random(seed)
+        self.phase = 'EMPTY'
+        self.phase_started = self.clock.now()
+        self.scans = 0
+        self.errors = 0
+
+    def at_sras_xy(self, x, y):
+        return (abs(x - self.sras_position["xpos"]) < self.tolerance and
+                abs(y - self.sras_position["ypos"]) < self.tolerance)
+
+    def step(self, now):
+        x, y, z = self.stage_position()
+        at_xy = self.at_sras_xy(x, y)
+        at_z = abs(z - self.sras_position["zpos"]) < self.tolerance
+        if self.phase == 'EMPTY' and at_xy and at_z:
+            self.phase = 'SAMPLE_PLACED'
+        elif self.phase == 'SAMPLE_PLACED' and at_xy and z < self.tolerance:
+            self.phase = 'SCANNING'
+            self.phase_started = now
+        elif self.phase == 'SCANNING' and now - self.phase_started >= self.scan_s:
+            self.scans += 1
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                self.z_io.set_input(SCAN_ERROR_INPUT, True)
+            else:
+                self.z_io.set_input(SCAN_COMPLETE_INPUT, True)
+            self.phase = 'DONE'
+        elif self.phase == 'DONE' and at_xy and at_z:
+            self.phase = 'PICKED_UP'
+        elif self.phase == 'PICKED_UP' and not at_xy:
+            self.z_io.set_input(SCAN_COMPLETE_INPUT, False)
+            self.z_io.set_input(SCAN_ERROR_INPUT, False)
+            self.phase = 'EMPTY'